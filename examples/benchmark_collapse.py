@@ -0,0 +1,78 @@
+from opiter import OptionsArray, OptionsDict
+from opiter.options_tree_elements import OptionsTreeElement
+from opiter.node_info import NodeInfo, Position
+
+from time import time
+from copy import deepcopy
+
+
+## INPUTS
+
+n_samples = 3
+array_lengths = [100, 100, 10]
+
+## PREPROCESSING
+
+def make_tree():
+    """
+    Creates a tree with 10^5 leaves, with items of assorted types.
+    Each timed run gets a fresh tree, so that nothing cached on the
+    tree by one run can speed up the next.
+    """
+    arrays = [OptionsArray(chr(ord('a') + i), range(n))
+              for i, n in enumerate(array_lengths)]
+    options_tree = reduce(lambda x, y: x * y, arrays)
+    options_tree.update({'ratio': 0.5, 'label': 'run', 'limits': [0, 1]})
+    return options_tree
+
+# the classes with hand-written __deepcopy__ methods, which can be
+# removed to fall back on the generic implementation
+fast_path_classes = [OptionsDict, OptionsTreeElement, NodeInfo, Position]
+stash = dict((cls, cls.__dict__['__deepcopy__']) for cls in fast_path_classes)
+
+def disable_fast_paths():
+    for cls in stash:
+        del cls.__deepcopy__
+
+def enable_fast_paths():
+    for cls, method in stash.items():
+        cls.__deepcopy__ = method
+
+def run_collapse():
+    options_tree = make_tree()
+    t0 = time()
+    options_dicts = options_tree.collapse()
+    return time() - t0, options_dicts
+
+results_fmt = "{0:11.3f}{1:12.3f}"
+
+print "\nCollapsing a tree with {} leaves".format(make_tree().count_leaves())
+print
+print " trial#   fast paths    generic"
+
+## PROCESSING
+
+fast_times = []
+generic_times = []
+for i in range(n_samples):
+    fast_time, fast_dicts = run_collapse()
+    disable_fast_paths()
+    try:
+        generic_time, generic_dicts = run_collapse()
+    finally:
+        enable_fast_paths()
+    assert fast_dicts == generic_dicts
+    fast_times.append(fast_time)
+    generic_times.append(generic_time)
+    # report
+    print "{0:5g} ".format(i+1) + results_fmt.format(fast_time, generic_time)
+
+print
+print "  ave." + results_fmt.format(sum(fast_times) / n_samples,
+                                    sum(generic_times) / n_samples)
+print "speed-up: {:.1f}x".format(sum(generic_times) / sum(fast_times))
+
+# deep-copying the collapsed dictionaries, e.g. to keep a pristine set
+t0 = time()
+deepcopy(fast_dicts)
+print "\ndeep copy of the leaves: {:.3f}s".format(time() - t0)
@@ -6,10 +6,11 @@ from options_array import OptionsArray
 
 # provide some useful stuff
 from options_dict import CallableOption, Lookup, GetString, \
-    transform_items, unlink, Check, Remove, \
+    transform_items, unlink, Check, Remove, Exclude, \
     missing_dependencies, unpicklable
-from options_array import OptionsArrayFactory
-from options_tree_elements import product
+from options_array import OptionsArrayFactory, from_spec
+from options_tree_elements import product, diff
+from leaf_snapshot import LeafSnapshot
 from utilities import pretty_print, smap, pmap, \
     ExpandTemplate, RunProgram, SimpleTemplateEngine, \
     Jinja2TemplateEngine
@@ -0,0 +1,263 @@
+from base import OptionsBaseException
+from options_dict import OptionsDict
+from node_info import Position
+from cPickle import Pickler, Unpickler, dumps, loads, HIGHEST_PROTOCOL
+from cStringIO import StringIO
+from mmap import mmap, ACCESS_READ
+import struct
+import errno
+import os
+
+
+# identifies a file written by write_snapshot, followed by the format
+# version, the number of leaves and the positions of the sections
+# after the leaf records
+MAGIC = 'OPITERSS'
+VERSION = 1
+HEADER = struct.Struct('<8sI5Q')
+OFFSET = struct.Struct('<Q')
+
+
+class LeafSnapshotException(OptionsBaseException):
+    pass
+
+
+def write_snapshot(options_dicts, path):
+    """
+    Writes the options dictionaries from the iterable options_dicts to
+    a file at path which can be read back by LeafSnapshot.  Each
+    dictionary is pickled separately, preceded by the header and
+    followed by
+
+    - a table of the offsets of the pickled dictionaries,
+    - a pickled table of the keys and node names, which the pickled
+      dictionaries refer to rather than repeat,
+    - the indices of the dictionaries sorted by name, and
+    - the offsets of the sorted names, followed by the names
+      themselves.
+
+    The dictionaries are written as they come, and only the offsets,
+    the shared objects and the names are kept until the end.  Used by
+    OptionsTreeElement.snapshot.
+    """
+    # The keys and most of the node information (its classes,
+    # attribute names, node names, array names and tags) are shared
+    # between the dictionaries.  They are added to the table as they
+    # are first met.
+    table = [Position]
+    table_ids = {id(Position): 0}
+    def share(obj):
+        if id(obj) not in table_ids:
+            table_ids[id(obj)] = len(table)
+            table.append(obj)
+    def share_objects(od):
+        for key in dict.iterkeys(od):
+            share(key)
+        for node_info in od._node_info:
+            share(node_info.__class__)
+            for name, value in node_info.__dict__.iteritems():
+                share(name)
+                if isinstance(value, Position):
+                    for position_name in value.__dict__:
+                        share(position_name)
+                elif not isinstance(value, (int, long)):
+                    share(value)
+
+    # Write to a temporary file which then replaces any existing
+    # file, since truncating a file that is mapped by a LeafSnapshot
+    # would crash the process reading it.  It's made in the same
+    # directory so that the rename doesn't cross file systems, and
+    # with a unique name so that concurrent snapshots don't collide.
+    # Unlike mkstemp, os.open lets the umask decide who can read it,
+    # as for any file made with open.
+    while True:
+        temp_path = '{}.{}.tmp'.format(path, os.urandom(6).encode('hex'))
+        try:
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                         getattr(os, 'O_BINARY', 0), 0666)
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    f = os.fdopen(fd, 'wb')
+    try:
+        f.write('\0' * HEADER.size)
+        offsets = []
+        names = []
+        buf = StringIO()
+        for i, od in enumerate(options_dicts):
+            share_objects(od)
+            offsets.append(f.tell())
+            buf.seek(0)
+            buf.truncate()
+            pickler = Pickler(buf, HIGHEST_PROTOCOL)
+            pickler.persistent_id = lambda obj: table_ids.get(id(obj))
+            try:
+                pickler.dump((dict.copy(od), od._node_info))
+            except Exception as e:
+                raise LeafSnapshotException(
+                    "couldn't pickle {}: {}.  Dependent items defined in "
+                    "a class or closure can be unlinked by an item hook "
+                    "(see unlink).".format(od, e))
+            f.write(buf.getvalue())
+            name = od.get_string()
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            names.append((name, i))
+        offsets.append(f.tell())
+
+        offsets_pos = f.tell()
+        f.write(struct.pack('<{}Q'.format(len(offsets)), *offsets))
+        table_pos = f.tell()
+        f.write(dumps(table, HIGHEST_PROTOCOL))
+
+        names.sort()
+        order_pos = f.tell()
+        f.write(struct.pack('<{}Q'.format(len(names)),
+                            *[i for name, i in names]))
+        names_pos = f.tell()
+        name_offsets = [names_pos + OFFSET.size * (len(names) + 1)]
+        for name, i in names:
+            name_offsets.append(name_offsets[-1] + len(name))
+        f.write(struct.pack('<{}Q'.format(len(name_offsets)),
+                            *name_offsets))
+        for name, i in names:
+            f.write(name)
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, len(names),
+                            offsets_pos, table_pos, order_pos, names_pos))
+    except:
+        f.close()
+        os.remove(temp_path)
+        raise
+    f.close()
+    os.rename(temp_path, path)
+
+
+class LeafSnapshot:
+    """
+    Gives access to the options dictionaries written to a file by
+    OptionsTreeElement.snapshot, e.g.
+        tree.snapshot('sweep.snapshot')
+        leaves = LeafSnapshot('sweep.snapshot')
+        leaves[10]
+        leaves['A_2']
+
+    The file is memory-mapped, and only the dictionaries that are
+    asked for are unpickled, each time they are asked for.  Several
+    processes can therefore share a large snapshot through the page
+    cache.  A LeafSnapshot can itself be pickled, e.g. to send it to
+    a multiprocessing.Pool, in which case the file is mapped again
+    when it is unpickled.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.open()
+
+
+    def open(self):
+        """
+        Maps the file and reads the header and the table of shared
+        objects.
+        """
+        with open(self.path, 'rb') as f:
+            try:
+                self.buffer = mmap(f.fileno(), 0, access=ACCESS_READ)
+            except ValueError:
+                # e.g. the file is empty
+                raise LeafSnapshotException(
+                    "{} isn't a leaf snapshot".format(self.path))
+        if len(self.buffer) < HEADER.size or \
+           self.buffer[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise LeafSnapshotException(
+                "{} isn't a leaf snapshot".format(self.path))
+        magic, version, self.n_leaves, self.offsets_pos, table_pos, \
+            self.order_pos, self.names_pos = \
+            HEADER.unpack_from(self.buffer)
+        if version != VERSION:
+            self.close()
+            raise LeafSnapshotException(
+                "unrecognised snapshot version: {}".format(version))
+        self.table = loads(self.buffer[table_pos:self.order_pos])
+
+
+    def close(self):
+        self.buffer.close()
+
+
+    def get_leaf(self, index):
+        """
+        Returns a new OptionsDict unpickled from the file.
+        """
+        start, end = struct.unpack_from(
+            '<2Q', self.buffer, self.offsets_pos + OFFSET.size * index)
+        unpickler = Unpickler(StringIO(self.buffer[start:end]))
+        unpickler.persistent_load = self.table.__getitem__
+        items, node_info = unpickler.load()
+        od = OptionsDict()
+        dict.update(od, items)
+        od._node_info = node_info
+        return od
+
+
+    def index(self, name):
+        """
+        Returns the index of the first leaf with the given name, found
+        by a binary search of the sorted names.
+        """
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        lo, hi = 0, self.n_leaves
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_sorted_name(mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.n_leaves or self.get_sorted_name(lo) != name:
+            raise KeyError(name)
+        return OFFSET.unpack_from(
+            self.buffer, self.order_pos + OFFSET.size * lo)[0]
+
+
+    def get_sorted_name(self, position):
+        # Helper to index().  Returns the name at the given position in
+        # sorted order.
+        start, end = struct.unpack_from(
+            '<2Q', self.buffer, self.names_pos + OFFSET.size * position)
+        return self.buffer[start:end]
+
+
+    def __len__(self):
+        return self.n_leaves
+
+    def __getitem__(self, subscript):
+        if isinstance(subscript, basestring):
+            return self.get_leaf(self.index(subscript))
+        if isinstance(subscript, slice):
+            return [self.get_leaf(i) for i in
+                    xrange(*subscript.indices(self.n_leaves))]
+        if subscript < 0:
+            subscript += self.n_leaves
+        if not 0 <= subscript < self.n_leaves:
+            raise IndexError("snapshot index out of range")
+        return self.get_leaf(subscript)
+
+    def __iter__(self):
+        for i in xrange(self.n_leaves):
+            yield self.get_leaf(i)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.open()
@@ -1,4 +1,5 @@
 from base import OptionsBaseException
+from copy import copy, deepcopy
 
 
 class Position:
@@ -30,6 +31,9 @@ class Position:
             result *= self.collection_size == other.collection_size
         return result
 
+    def __deepcopy__(self, memo):
+        return self.__class__(self.index, self.collection_size)
+
     
 class NodeInfoException(OptionsBaseException):
     pass
@@ -76,5 +80,12 @@ class NodeInfo:
                 raise IndexError("list index out of range")
         return index
         
+    def __deepcopy__(self, memo):
+        # Names and tags are never modified in place, and there is one
+        # set of them per collection, so the copy shares them.
+        result = copy(self)
+        result.position = deepcopy(self.position, memo)
+        return result
+
     def __str__(self):
         return self.get_string()
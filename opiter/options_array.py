@@ -1,9 +1,16 @@
 from base import OptionsBaseException
-from options_tree_elements import OptionsTreeElement
+from options_tree_elements import OptionsTreeElement, encode_value, \
+    decode_value, SPEC_VERSION
 from node_info import NodeInfo, Position
 from options_node import OptionsNode, OptionsNodeException
+from options_dict import OptionsDict
 from copy import deepcopy
+from types import InstanceType
+from itertools import izip
+from bisect import bisect_right
+from contextlib import contextmanager
 from warnings import warn
+import json
 
 
 class OptionsArrayException(OptionsBaseException):
@@ -67,7 +74,14 @@ class ArrayNodeInfo(NodeInfo):
         result = isinstance(other, ArrayNodeInfo)
         if result:
             result *= self.array_name == other.array_name
-            result *= self.node_names == other.node_names
+            # the names may be held in any sequence, e.g. a list or
+            # VirtualNodeNames, which compares itself with any other
+            names, other_names = self.node_names, other.node_names
+            if type(names) is not type(other_names) and \
+               not isinstance(names, VirtualNodeNames) and \
+               not isinstance(other_names, VirtualNodeNames):
+                names, other_names = list(names), list(other_names)
+            result *= names is other_names or names == other_names
             result *= self.node_index == other.node_index
         return result
 
@@ -76,6 +90,12 @@ class OptionsArray(OptionsTreeElement):
     """
     A sequence of OptionsNodes.
     """
+    # the number of batch() blocks in progress, and whether the node
+    # information needs updating when they finish
+    batch_depth = 0
+    node_info_stale = False
+    # see get_leaf_offsets
+    leaf_offsets = None
 
     def __init__(self, array_name, elements, names=None, name_format='{}',
                  tags=[], list_hooks=[], dict_hooks=[], item_hooks=[]):
@@ -109,7 +129,10 @@ class OptionsArray(OptionsTreeElement):
                                     item_hooks=item_hooks)
         self.name = array_name
         self.tags = tags
-        self.nodes = []
+        self._nodes = []
+        self.node_names = None
+        self.name_index = None
+        self.value_index = None
         
         if names:
             arg_list = zip(names, elements)
@@ -123,12 +146,32 @@ class OptionsArray(OptionsTreeElement):
             except OptionsNodeException as e:
                 raise OptionsArrayException(str(e))
             # append to the list
-            self.nodes.append(node)
+            self._nodes.append(node)
 
         # set array node information in each node.  This will replace
         # any preexisting node information.
         self.update_node_info()
 
+
+    @classmethod
+    def from_range(Class, array_name, *args, **kwargs):
+        """
+        Returns a VirtualOptionsArray whose values are given by
+        xrange(*args).  The keyword arguments are passed on to the
+        VirtualOptionsArray constructor.
+        """
+        return VirtualOptionsArray(array_name, xrange(*args), **kwargs)
+
+    @classmethod
+    def from_sequence(Class, array_name, values, **kwargs):
+        """
+        Returns a VirtualOptionsArray whose values are taken from a
+        sequence, such as a list or a numpy array, without creating
+        any nodes up front.  The keyword arguments are passed on to
+        the VirtualOptionsArray constructor.
+        """
+        return VirtualOptionsArray(array_name, values, **kwargs)
+
     
     def create_options_node(self, arg1={}, arg2={}, names=None,
                             name_format='{}'):
@@ -148,73 +191,471 @@ class OptionsArray(OptionsTreeElement):
                                node_key=self.name, tags=self.tags)
 
         
-    def collapse(self):
+    def split_leaf_range(self, leaf_range):
         """
-        Returns a list of options dictionaries corresponding to the leaves
-        in the the present tree structure.  Each dictionary is the
-        result of a merge from the root, through the branch nodes, to
-        the corresponding leaf.
+        Returns a list of (node, leaf_range) pairs for the nodes whose
+        subtrees contain leaves in the given range, with the range
+        narrowed to each subtree.  Used by
+        OptionsTreeElement.iter_leaves.
         """
+        if leaf_range is None:
+            return [(node, None) for node in self._nodes]
+        start, stop, step = leaf_range
         result = []
-        for el in self:
-            result += el.collapse()
-            
-        self.apply_hooks(result)
+        offset = 0
+        for node, count in zip(self._nodes, self.count_node_leaves()):
+            if offset >= stop:
+                break
+            if start >= offset:
+                first = start
+            else:
+                first = start + -((start - offset) // step) * step
+            end = min(stop, offset + count)
+            if first < end:
+                result.append((node, (first - offset, end - offset, step)))
+            offset += count
         return result
-    
-        
-    def multiply_attach(self, tree):
+
+
+    def child_with_leaf(self, index):
         """
-        Appends a copy of the given tree to each leaf node in the
-        present tree.
+        Returns the node whose subtree contains the given leaf and the
+        index of the leaf within that subtree.  Used by
+        OptionsTreeElement.leaf.
         """
-        # delegate to each node
-        for el in self:
-            el.multiply_attach(tree)
+        node_index, sub_index = self.split_leaf_index(index)
+        return self.node_at(node_index), sub_index
 
 
-    def attach(self, tree):
+    def node_at(self, index):
         """
-        Appends a copy of each root node in the tree argument (or
-        whichever elements get traversed during iteration) to a
-        corresponding leaf node in the present tree.  Returns the
-        depleted source tree.
+        Returns the node at the given (nonnegative) index, which the
+        client mustn't modify.  Used by the methods that look up
+        leaves.
         """
-        # delegate to each node
-        for el in self:
-            tree = el.attach(tree)
-        return tree
+        return self._nodes[index]
 
 
-    def donate_copy(self, acceptor):
-        one_node_array = deepcopy(self[0])
-        one_node_array.update_node_info()
-        if acceptor:
-            acceptor.attach(one_node_array)
+    def split_leaf_index(self, index):
+        """
+        Converts a leaf index into the index of the node whose subtree
+        contains the leaf and the index of the leaf within that
+        subtree.  Where the subtrees are all the same size, as in a
+        regular product of arrays, the leaf index is decoded as a
+        mixed-radix number; otherwise the node is found by a binary
+        search of the leaf offsets.
+        """
+        offsets = self.get_leaf_offsets()
+        if not 0 <= index < offsets[-1]:
+            raise IndexError("leaf index out of range")
+        if self.subtree_shape is not None:
+            return divmod(index, offsets[1])
+        node_index = bisect_right(offsets, index) - 1
+        return node_index, index - offsets[node_index]
+
+
+    def leaf_offset(self, node_index):
+        """
+        Returns the index of the first leaf beneath the given node.
+        """
+        return self.get_leaf_offsets()[node_index]
+
+
+    def get_leaf_offsets(self):
+        """
+        Returns a list of the index of the first leaf beneath each
+        node, followed by the total number of leaves.  The list is
+        cached along with the leaf count; see count_and_shape.
+        """
+        self.cache_shape()
+        return self.leaf_offsets
+
+
+    def match_name(self, name, node_separator):
+        """
+        Returns (node, name, leaf offset) tuples for the nodes whose
+        names the string identifier name could start with.  Used by
+        OptionsTreeElement.find_leaf_by_name.
+        """
+        # The identifier may start with any node name, up to one of
+        # the separators.  A nameless node could also be responsible.
+        prefixes = [name]
+        end = name.find(node_separator)
+        while end >= 0:
+            prefixes.append(name[:end])
+            end = name.find(node_separator, end + 1)
+        prefixes.append('')
+        name_index = self.get_name_index()
+        return [(self.node_at(i), name, self.leaf_offset(i))
+                for prefix in prefixes for i in name_index.get(prefix, [])]
+
+
+    def match_items(self, items):
+        """
+        Returns (node, leaf offset) pairs for the nodes matching the
+        value given for the array in items.  Used by
+        OptionsTreeElement.find_leaf_by_items.
+        """
+        if self.name in items:
+            value = items[self.name]
+            try:
+                node_indices = self.get_value_index().get(value)
+            except TypeError:
+                # unhashable value
+                node_indices = None
+            if node_indices is None:
+                # try treating the value as a node name
+                node_indices = self.get_name_index().get(str(value), [])
+        elif len(self) == 1:
+            node_indices = [0]
         else:
-            acceptor = one_node_array
-        # also return (a copy of) the depleted array
-        return acceptor, self[1:]
+            raise OptionsArrayException(
+                "'{}' must be given in order to locate a leaf".\
+                format(self.name))
+        return [(self.node_at(i), self.leaf_offset(i)) for i in node_indices]
 
 
-    def count_leaves(self):
-        return sum([el.count_leaves() for el in self.nodes])
+    def get_name_index(self):
+        """
+        Returns a dict mapping node names to lists of the indices of
+        the nodes with those names, in order.  The dict is built on
+        first use and discarded when the array changes.
+        """
+        if self.name_index is None:
+            self.name_index = {}
+            for i, node in enumerate(self._nodes):
+                self.name_index.setdefault(str(node), []).append(i)
+        return self.name_index
 
-        
-    def update(self, items):
+
+    def get_node_index(self, subscript):
         """
-        Updates the leaf dictionaries with items.
+        Returns the index of the first node named subscript, or else
+        subscript itself, which is then taken to be an index.
         """
-        for el in self:
-            el.update(items)
+        indices = self.get_name_index().get(subscript)
+        if indices is None:
+            return subscript
+        return indices[0]
+
+
+    def get_value_index(self):
+        """
+        Returns a dict mapping the values stored under the array name in
+        each node to lists of node indices, in order.  The dict is
+        built on first use and discarded when the array changes.
+        """
+        if self.value_index is None:
+            self.value_index = {}
+            for i, node in enumerate(self._nodes):
+                try:
+                    value = dict.__getitem__(node._options_dict, self.name)
+                    self.value_index.setdefault(value, []).append(i)
+                except (KeyError, TypeError):
+                    # no value, or an unhashable one
+                    pass
+        return self.value_index
+
+
+    def count_node_leaves(self):
+        """
+        Returns a list of the number of leaves beneath each node.
+        """
+        self.cache_shape()
+        return [el.leaf_count for el in self._nodes]
+
+
+    def replace_children(self, children):
+        """
+        Returns a shallow copy of the present array with the given
+        nodes, whose node information is updated accordingly.  The
+        nodes and their dictionaries are copied when their node
+        information changes, but the values and the subtrees are
+        shared; see OptionsTreeElement.own.  Used by
+        OptionsTreeElement.prune and for slicing.
+        """
+        result = self.copy_element()
+        result._nodes = [self.share(node) for node in children]
+        result.update_node_info()
+        # the copied leaf count no longer applies
+        result.leaf_count = None
+        return result
+
+
+    def match_children(self, other):
+        """
+        Pairs the present array's nodes with those of another array by
+        name.  Returns a list of (node, other_node) pairs in the order
+        of the other array, with None in place of a missing partner and
+        nodes that have been removed from the present array placed
+        before the next remaining node.  Returns None if either array
+        has duplicate names.  Used by diff.
+        """
+        names = [str(node) for node in self._nodes]
+        other_names = [str(node) for node in other._nodes]
+        if len(set(names)) < len(names) or \
+           len(set(other_names)) < len(other_names):
+            return None
+        indices = dict((name, i) for i, name in enumerate(names))
+        other_names = set(other_names)
+        result = []
+        next_index = 0
+        for node in other._nodes:
+            i = indices.get(str(node))
+            if i is None:
+                result.append((None, node))
+                continue
+            for removed in self._nodes[next_index:i]:
+                if str(removed) not in other_names:
+                    result.append((removed, None))
+            next_index = max(next_index, i + 1)
+            result.append((self._nodes[i], node))
+        for removed in self._nodes[next_index:]:
+            if str(removed) not in other_names:
+                result.append((removed, None))
+        return result
+
+
+    def get_value_spec(self):
+        """
+        Returns the values stored under the array name in each node,
+        the node names, the items the nodes hold besides the values and
+        their shared child, if the nodes differ in nothing else (such
+        as tags, hooks or children); otherwise returns None.  Used by
+        get_spec.
+        """
+        if not self._nodes:
+            return [], [], {}, None
+        child = self._nodes[0]._child
+        values = []
+        names = []
+        items = None
+        for node in self._nodes:
+            if node._child is not child or node.tags != self.tags or \
+               node.list_hooks or node.dict_hooks or node.item_hooks or \
+               not dict.__contains__(node._options_dict, self.name):
+                return None
+            node_items = dict(node._options_dict.iteritems())
+            values.append(node_items.pop(self.name))
+            names.append(node.name)
+            if items is None:
+                items = node_items
+            else:
+                try:
+                    if node_items != items:
+                        return None
+                except (ValueError, TypeError):
+                    # e.g. numpy arrays, which can't be compared this way
+                    return None
+        return values, names, items, child
+
+
+    def get_spec(self, indices):
+        """
+        Returns a description of the present array, given the indices
+        of the descriptions of its descendants.  Where possible, the
+        nodes are described by their values, leaving out the names if
+        they are the default ones; see get_value_spec.  Used by
+        OptionsTreeElement.to_spec.
+        """
+        spec = {'array': self.name}
+        parts = self.get_value_spec()
+        if parts is None:
+            spec['nodes'] = [indices[id(node)] for node in self._nodes]
+        else:
+            values, names, items, child = parts
+            spec['values'] = [encode_value(v) for v in values]
+            for value, name in zip(values, names):
+                if type(value) not in (int, long, float, str) or \
+                   name != '{}'.format(value):
+                    spec['names'] = names
+                    break
+            if items:
+                spec['items'] = dict((k, encode_value(v))
+                                     for k, v in items.iteritems())
+            if child is not None:
+                spec['child'] = indices[id(child)]
+        if self.tags:
+            spec['tags'] = list(self.tags)
+        return spec
+
+
+    def get_spec_children(self):
+        """
+        Used by OptionsTreeElement.to_spec; see get_spec.
+        """
+        parts = self.get_value_spec()
+        if parts is None:
+            return self._nodes
+        child = parts[3]
+        return [] if child is None else [child]
+
+
+    def compare_locally(self, other):
+        """
+        Returns None if other is not an array with the same name and
+        length as the present array, or else the pairs of nodes to
+        compare next.  Used by OptionsTreeElement.__eq__.
+        """
+        if not isinstance(other, OptionsArray) or \
+           self.name != other.name or len(self) != len(other):
+            return None
+        return zip(self.get_nodes(), other.get_nodes())
+
+
+    def get_nodes(self):
+        """
+        Returns the list of nodes as they are, possibly shared with
+        other parents.  Used internally, by methods that don't modify
+        the nodes.
+        """
+        return self._nodes
+
+
+    def expose_nodes(self):
+        """
+        Returns the list of nodes, whose nodes the client may go on to
+        modify, so any that are shared with other parents are replaced
+        with copies first (see own).  Nodes added to or removed from
+        the list in place are not noticed, so shape_changed should be
+        called afterwards.
+        """
+        for i in range(len(self._nodes)):
+            self.own_node(i)
+            self._nodes[i].expose(self)
+        return self._nodes
+
+    nodes = property(expose_nodes)
+
+    def __setattr__(self, name, value):
+        # as for OptionsNode.child
+        if name == 'nodes':
+            value = list(value)
+            for node in value:
+                # the client holds the nodes
+                node.expose(self)
+            self.__dict__['_nodes'] = value
+            self.node_names = None
+            self.name_index = None
+            self.value_index = None
+            self.shape_changed()
+        else:
+            OptionsTreeElement.__setattr__(self, name, value)
+
+
+    def count_and_shape(self):
+        """
+        Returns the leaf count and shape of the present array's
+        subtree from the values cached on its nodes, and caches the
+        offsets of the nodes' leaves (see get_leaf_offsets).  Used by
+        OptionsTreeElement.cache_shape.
+        """
+        offsets = [0]
+        for el in self._nodes:
+            offsets.append(offsets[-1] + el.leaf_count)
+        self.leaf_offsets = offsets
+        count = offsets[-1]
+        shapes = [el.subtree_shape for el in self._nodes]
+        if not shapes:
+            return count, (0,)
+        if shapes[0] is None or shapes.count(shapes[0]) < len(shapes):
+            # irregular
+            return count, None
+        return count, (len(shapes),) + shapes[0]
+
+    
+    def own_node(self, index, memo=None):
+        """
+        Makes sure that the node at the given index is not shared with
+        any other parent, in preparation for modifying it.  Returns
+        True if the node needs modifying.  See
+        OptionsTreeElement.own.
+        """
+        self._nodes[index], modify = self.own(self._nodes[index], memo)
+        return modify
+
+
+    def own_child_at(self, index, memo=None):
+        """
+        Used by OptionsTreeElement.walk.
+        """
+        return self.own_node(index, memo)
+
+
+    def set_child_at(self, index, element):
+        """
+        Used by OptionsTreeElement.shallow_copy.
+        """
+        self._nodes[index] = element
+
+
+    def copy_element(self):
+        result = OptionsTreeElement.copy_element(self)
+        result._nodes = list(self._nodes)
+        return result
+
+
+    def copy_contents(self, memo):
+        """
+        Gives the copy its own list of nodes, which
+        OptionsTreeElement.__deepcopy__ fills with deep copies.
+        """
+        self._nodes = list(self._nodes)
+
+
+    def __getstate__(self):
+        # A copy made during a batch is not part of it, so bring the
+        # node information up to date first.
+        if self.node_info_stale:
+            self.refresh_node_info()
+        state = OptionsTreeElement.__getstate__(self)
+        state.pop('batch_depth', None)
+        # the indices are extended in place (see nodes_changed), so
+        # copies build their own
+        state['name_index'] = None
+        state['value_index'] = None
+        return state
+
+
+    def peek_children(self):
+        return self._nodes
+
+
+    def donate_copy(self, acceptor):
+        # the rest of the nodes are donated by a NodeDonor rather than
+        # by a depleted copy of the array
+        return NodeDonor(self).donate_copy(acceptor)
+
+
+    def update_locally(self, items):
+        """
+        Discards the value index, since the items may include new
+        values for the array.  Used by OptionsTreeElement.update.
+        """
+        self.value_index = None
 
 
     def update_node_info(self):
         """
         Updates the nodes with node information appropriate to an
-        OptionsArray.
+        OptionsArray, and discards the indices of their names and
+        values in case the nodes have been modified.
         """
-        for i, node in enumerate(self.nodes):
+        self.name_index = None
+        self.value_index = None
+        self.refresh_node_info()
+
+
+    def refresh_node_info(self):
+        """
+        Updates the node information after the array has changed,
+        leaving the indices to nodes_changed.
+        """
+        self.node_names = None
+        self.node_info_stale = False
+        for i in range(len(self._nodes)):
+            self.own_node(i)
+            node = self._nodes[i]
             try:
                 node.update_node_info(self.create_node_info(i))
             except:
@@ -227,102 +668,904 @@ class OptionsArray(OptionsTreeElement):
         Overrideable factory method, used by
         OptionsArray.update_node_info.
         """
-        node_names = [str(node) for node in self.nodes]
-        return ArrayNodeInfo(self.name, node_names, index, tags=self.tags)
+        return ArrayNodeInfo(self.name, self.get_node_names(), index,
+                             tags=self.tags)
+
+
+    def get_node_names(self):
+        """
+        Returns a tuple of the node names, which is shared by the node
+        information of every node.  The tuple is built on first use and
+        discarded when the array changes.
+        """
+        if self.node_names is None:
+            self.node_names = tuple(str(node) for node in self._nodes)
+        return self.node_names
+
+    
+    def nodes_changed(self, start=None):
+        """
+        Updates the node information after nodes have been added,
+        removed or replaced, unless a batch is in progress (see
+        batch), and invalidates the cached shapes.  If the nodes were
+        only appended, start is the index of the first new one, and
+        any indices of the names and values are extended rather than
+        discarded, which saves rebuilding them after every append in a
+        batch.
+        """
+        if start is None:
+            self.name_index = None
+            self.value_index = None
+        else:
+            for i in xrange(start, len(self._nodes)):
+                node = self._nodes[i]
+                if self.name_index is not None:
+                    self.name_index.setdefault(str(node), []).append(i)
+                if self.value_index is not None:
+                    try:
+                        value = dict.__getitem__(node._options_dict,
+                                                 self.name)
+                        self.value_index.setdefault(value, []).append(i)
+                    except (KeyError, TypeError):
+                        # no value, or an unhashable one
+                        pass
+        if self.batch_depth:
+            self.node_names = None
+            self.node_info_stale = True
+        else:
+            self.refresh_node_info()
+        self.shape_changed()
+
+
+    @contextmanager
+    def batch(self):
+        """
+        Returns a context manager that defers updating the node
+        information until the end of the with block, e.g.
+
+           with array.batch():
+               for node in nodes:
+                   array.append(node)
+
+        so that it is done once rather than after every change.
+        Blocks may be nested.  The node information of the array's
+        nodes is out of date until the outermost block finishes,
+        unless the array is copied first.
+        """
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if not self.batch_depth and self.node_info_stale:
+                self.refresh_node_info()
+
+
+    def check_nodes(self, items):
+        """
+        Returns the items as a list, making sure that they are all
+        OptionsNodes.  The client holds the nodes, which go into the
+        array as they are.
+        """
+        items = list(items)
+        for item in items:
+            if not isinstance(item, OptionsNode):
+                raise OptionsArrayException("item needs to be an OptionsNode")
+        for item in items:
+            item.expose(self)
+        return items
 
     
     def append(self, item):
-        if not isinstance(item, OptionsNode):
-            raise OptionsArrayException("item needs to be an OptionsNode")
-        self.nodes.append(item)
-        self.update_node_info()
+        start = len(self._nodes)
+        self._nodes.extend(self.check_nodes([item]))
+        self.nodes_changed(start)
             
     def pop(self):
-        node = self.nodes.pop()
+        self.own_node(-1)
+        node = self._nodes.pop()
         # update node info on both sides
         node.update_node_info()
-        self.update_node_info()
+        self.nodes_changed()
         return node
+
+    def extend(self, items):
+        """
+        Appends several OptionsNodes, updating the node information
+        once.
+        """
+        start = len(self._nodes)
+        self._nodes.extend(self.check_nodes(items))
+        self.nodes_changed(start)
+
+    def insert_many(self, subscript, items):
+        """
+        Inserts several OptionsNodes before the node with the given
+        index or name, updating the node information once.
+        """
+        index = self.get_node_index(subscript)
+        self._nodes[index:index] = self.check_nodes(items)
+        self.nodes_changed()
+
+    def remove_many(self, subscripts):
+        """
+        Removes the nodes with the given indices or names, updating the
+        node information once.  Returns the removed nodes in array
+        order.
+        """
+        removed = {}
+        for subscript in subscripts:
+            index = self.get_node_index(subscript)
+            # raises the same errors as list indexing
+            self._nodes[index]
+            index %= len(self._nodes)
+            if index not in removed:
+                self.own_node(index)
+                removed[index] = self._nodes[index]
+                removed[index].update_node_info()
+        self._nodes = [node for i, node in enumerate(self._nodes)
+                      if i not in removed]
+        self.nodes_changed()
+        return [removed[i] for i in sorted(removed)]
         
     def __len__(self):
-        return len(self.nodes)
-            
-    def __eq__(self, other):
-        result = isinstance(other, OptionsArray)
-        if result:
-            result *= self.name == other.name
-            result *= len(self.nodes) == len(other.nodes)
-            for node, other in zip(self.nodes, other.nodes):
-                result *= node == other
-        return result
+        return len(self._nodes)
 
 
     def __getitem__(self, subscript):
         try:
             # treat argument as a slice
-            indices = subscript.indices(len(self.nodes))
+            indices = subscript.indices(len(self._nodes))
 
-            # return an array
-            return self.another(self.name, self.nodes[subscript],
-                                tags=self.tags)
+            # return a copy of the array which shares the nodes'
+            # subtrees and values rather than copying them; only the
+            # selected nodes and their dictionaries are copied, to
+            # hold the new node information
+            result = self.replace_children(self._nodes[subscript])
+            # as in the constructor, nodes that were added without an
+            # item for the array (e.g. by append) are given one
+            for node in result._nodes:
+                if self.name not in node.get_options_dict():
+                    node.own_options_dict(values=False)
+                    node.update_options_dict_general(node, self.name)
+                    node.touch()
+            return result
 
         except AttributeError:
-            try:
-                # treat argument as a name
-                index = [str(n) for n in self.nodes].index(subscript)
-            except ValueError:
-                # default to an index
-                index = subscript
+            # treat argument as a name, defaulting to an index
+            index = self.get_node_index(subscript)
 
-            # return a node
-            return self.nodes[index]
+            # return a node, which the client may go on to modify
+            self.own_node(index)
+            return self._nodes[index].expose(self)
 
 
     def __setitem__(self, subscript, value_or_values):
         try:
             # treat subscript as a slice
-            indices = subscript.indices(len(self.nodes))
+            indices = subscript.indices(len(self._nodes))
             # convert values to nodes 
-            self.nodes[subscript] = [self.create_options_node(v) \
+            self._nodes[subscript] = [self.create_options_node(v) \
                                          for v in value_or_values]
 
         except AttributeError:
-            try:
-                # treat subscript as a name
-                index = [str(n) for n in self.nodes].index(subscript)
-            except ValueError:
-                # default to an index
-                index = subscript
+            # treat argument as a name, defaulting to an index
+            index = self.get_node_index(subscript)
                 
             # convert value to a node
-            self.nodes[index] = self.create_options_node(value_or_values)
+            self._nodes[index] = self.create_options_node(value_or_values)
 
-        self.update_node_info()
+        self.nodes_changed()
 
 
     def __delitem__(self, subscript):
         try:
             # treat argument as a slice
-            indices = subscript.indices(len(self.nodes))
-            del self.nodes[subscript]
+            indices = subscript.indices(len(self._nodes))
+            del self._nodes[subscript]
 
         except AttributeError:
-            try:
-                # treat argument as a name
-                index = [str(n) for n in self.nodes].index(subscript)
-            except ValueError:
-                # default to an index
-                index = subscript
+            # treat argument as a name, defaulting to an index
+            index = self.get_node_index(subscript)
 
-            del self.nodes[index]
+            del self._nodes[index]
             
-        self.update_node_info()
+        self.nodes_changed()
 
         
     def __str__(self):
         return str(self.name)
 
 
+class NodeDonor:
+    """
+    Stands in for the depleted array while an array is attached to the
+    leaves of a tree (see OptionsTreeElement.attach).  Each leaf takes
+    a copy of the next node, so the array is copied one node at a time
+    rather than being rebuilt without its first node for every leaf.
+    """
+    def __init__(self, array):
+        self.array = array
+        self.nodes = array.get_nodes()
+        self.index = 0
+
+    def donate_copy(self, acceptor):
+        node_copy = deepcopy(self.nodes[self.index])
+        if self.index > 0 and \
+           self.array.name not in node_copy.get_options_dict():
+            # as for the nodes of an array slice, which the remainder
+            # of the array used to be
+            node_copy.own_options_dict()
+            node_copy.update_options_dict_general(node_copy,
+                                                  self.array.name)
+        node_copy.update_node_info()
+        if acceptor:
+            acceptor.attach(node_copy)
+        else:
+            acceptor = node_copy
+        self.index += 1
+        return acceptor, self
+
+    def __len__(self):
+        return len(self.nodes) - self.index
+
+    def get_remainder(self):
+        """
+        Returns a slice of the array holding the nodes that haven't
+        been donated.  Used by OptionsTreeElement.attach.
+        """
+        return self.array[self.index:]
+
+
+class VirtualNodeNames:
+    """
+    A sequence of the node names in a VirtualOptionsArray, which are
+    worked out from the values on demand.  Stands in for the list of
+    names held by ArrayNodeInfo.
+    """
+    def __init__(self, values, name_format='{}'):
+        self.values = values
+        self.name_format = name_format
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        return str(OptionsNode(self.values[index],
+                               name_format=self.name_format))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        try:
+            if len(self) != len(other):
+                return False
+        except TypeError:
+            return False
+        if isinstance(other, VirtualNodeNames) and \
+           self.name_format == other.name_format and \
+           same_values(self.values, other.values):
+            # saves formatting every name; different values can still
+            # give the same names, though
+            return True
+        for name, other_name in izip(self, other):
+            if name != other_name:
+                return False
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __deepcopy__(self, memo):
+        # the names can't be changed, so copies of the node information
+        # (e.g. in collapsed dictionaries) can share them along with
+        # the values
+        return self
+
+
+def same_values(values, other_values):
+    """
+    Returns True if two sequences of values are equal, comparing an
+    xrange with another by its start and step.  Used by
+    VirtualNodeNames.
+    """
+    if values is other_values:
+        return True
+    if len(values) != len(other_values):
+        return False
+    if isinstance(values, xrange) and isinstance(other_values, xrange):
+        return not values or values[0] == other_values[0] and \
+            (len(values) == 1 or values[1] == other_values[1])
+    for value, other_value in izip(values, other_values):
+        if value != other_value:
+            return False
+    return True
+
+
+def slice_values(values, subscript):
+    """
+    Returns the values selected by a slice, keeping an xrange as an
+    xrange.  Used by VirtualOptionsArray.
+    """
+    if not isinstance(values, xrange):
+        return values[subscript]
+    indices = xrange(*subscript.indices(len(values)))
+    if not indices:
+        return xrange(0)
+    start = values[indices[0]]
+    if len(values) > 1:
+        step = (values[1] - values[0]) * (indices[1] - indices[0] \
+                                          if len(indices) > 1 else 1)
+    else:
+        step = 1
+    return xrange(start, start + len(indices) * step, step)
+
+
+class VirtualOptionsArray(OptionsArray):
+    """
+    An OptionsArray that only stores a sequence of values and a name
+    format, and creates the nodes on demand, e.g. during collapse.
+    The memory taken up by the array itself therefore doesn't depend
+    on the number of values, which suits long parameter scans, as in
+
+       OptionsArray.from_sequence('Re', numpy.logspace(2, 6, 20000))
+
+    Each node is created as it would be by the OptionsArray
+    constructor, together with any items added to the array by
+    update() and its node information.  The sequence of node names
+    held by the node information is worked out on demand too.
+
+    Everything multiplied onto the array is shared by all of its
+    nodes, and stored as a single child.  The array can be updated,
+    multiplied, sliced, collapsed and compared, but nodes can't be
+    added to it, removed from it or changed individually, nor can
+    distinct trees be attached to its nodes by addition.  Modifying a
+    node returned by indexing has no effect on the array.  Use
+    materialize() to get an ordinary OptionsArray that allows these
+    things, which is also what constrain() and diff() work with.
+    """
+    def __init__(self, array_name, values, name_format='{}', tags=[],
+                 list_hooks=[], dict_hooks=[], item_hooks=[]):
+        OptionsTreeElement.__init__(self, list_hooks=list_hooks,
+                                    dict_hooks=dict_hooks,
+                                    item_hooks=item_hooks)
+        self.name = array_name
+        self.tags = tags
+        if not hasattr(values, '__getitem__') or \
+           not hasattr(values, '__len__'):
+            # e.g. a generator
+            values = tuple(values)
+        self.values = values
+        self.name_format = name_format
+        # items added by update, copied when either a shallow copy of
+        # the array or the array itself modifies them
+        self.items = {}
+        self.items_shared = False
+        self._child = None
+        # see get_node_names, get_name_index and get_value_index
+        self.node_names = None
+        self.name_index = None
+        self.value_index = None
+
+
+    def create_node(self, index):
+        """
+        Returns a new node for the value at the given (nonnegative)
+        index, complete with node information and the array's child.
+        """
+        node = self.create_options_node(self.values[index],
+                                        name_format=self.name_format)
+        node._options_dict.update(self.items)
+        if self._child is not None:
+            # the child is shared with every other node
+            node._child = self.share(self._child)
+        node.update_node_info(self.create_node_info(index))
+        return node
+
+
+    def get_node_names(self):
+        """
+        Returns a sequence which creates node names on demand, shared
+        by the node information of every node.  Used by
+        OptionsArray.create_node_info.
+        """
+        if self.node_names is None:
+            self.node_names = VirtualNodeNames(self.values, self.name_format)
+        return self.node_names
+
+
+    def node_at(self, index):
+        return self.create_node(index)
+
+
+    def materialize(self):
+        """
+        Returns an ordinary OptionsArray holding the nodes of the
+        present array, which share its child.
+        """
+        result = OptionsArray(self.name, [], tags=self.tags,
+                              list_hooks=self.list_hooks,
+                              dict_hooks=self.dict_hooks,
+                              item_hooks=self.item_hooks)
+        # the nodes already have node information, so there is no need
+        # to update it and make a list of names for each node
+        result._nodes = self.get_nodes()
+        return result
+
+
+    def get_nodes(self):
+        """
+        Returns a list of newly created nodes, which share the present
+        array's child.
+        """
+        return [self.create_node(i) for i in xrange(len(self))]
+
+    # modifying the nodes has no effect on the array
+    nodes = property(get_nodes)
+
+
+    def get_spec(self, indices):
+        """
+        Returns a description of the present array, holding the values
+        and name format rather than the nodes.  Used by
+        OptionsTreeElement.to_spec.
+        """
+        spec = {'array': self.name, 'virtual': True,
+                'values': encode_value(self.values),
+                'name_format': encode_value(self.name_format)}
+        if self.items:
+            spec['items'] = dict((k, encode_value(v))
+                                 for k, v in self.items.iteritems())
+        if self._child is not None:
+            spec['child'] = indices[id(self._child)]
+        if self.tags:
+            spec['tags'] = list(self.tags)
+        return spec
+
+
+    def get_spec_children(self):
+        return self.peek_children()
+
+
+    def compute_hash(self, child_hashes):
+        """
+        Returns the same structural hash as an ordinary OptionsArray
+        holding the nodes of the present array.  Used by
+        OptionsTreeElement.refresh_hashes.
+        """
+        node_hashes = [node.compute_hash(child_hashes)
+                       for node in self.get_nodes()]
+        return hash((str(self), None, tuple(node_hashes)))
+
+
+    def copy_element(self):
+        result = OptionsTreeElement.copy_element(self)
+        self.items_shared = True
+        result.items_shared = True
+        return result
+
+
+    def copy_contents(self, memo):
+        """
+        Replaces the values and items with deep copies.  Used by
+        OptionsTreeElement.__deepcopy__, which copies the child.
+        """
+        self.values = deepcopy(self.values, memo)
+        self.node_names = None
+        self.items = deepcopy(self.items, memo)
+
+
+    def peek_children(self):
+        if self._child is None:
+            return []
+        else:
+            return [self._child]
+
+
+    def get_child(self):
+        """
+        Returns the child shared by the nodes, which the client may go
+        on to modify, so it is replaced with a copy first if it is
+        shared with another parent (see own).
+        """
+        if self._child is None:
+            return None
+        self.own_child_at(0)
+        return self._child.expose(self)
+
+    child = property(get_child)
+
+    def __setattr__(self, name, value):
+        # as for OptionsNode.child
+        if name == 'child':
+            if value is not None:
+                value.expose(self)
+            self.__dict__['_child'] = value
+            self.shape_changed()
+        else:
+            OptionsTreeElement.__setattr__(self, name, value)
+
+
+    def own_child_at(self, index, memo=None):
+        """
+        Used by OptionsTreeElement.walk; index can only be 0.
+        """
+        self._child, modify = self.own(self._child, memo)
+        return modify
+
+
+    def set_child_at(self, index, element):
+        """
+        Used by OptionsTreeElement.shallow_copy; index can only be 0.
+        """
+        self._child = element
+
+
+    def get_local_keys(self):
+        return [self.name] + self.items.keys()
+
+
+    def has_same_items(self, other):
+        if self.name_format != other.name_format or \
+           self.items != other.items or len(self) != len(other):
+            return False
+        for value, other_value in izip(self.values, other.values):
+            if value != other_value:
+                return False
+        return True
+
+
+    def update_locally(self, items):
+        """
+        Records items to be added to the nodes if they are leaves.
+        Used by OptionsTreeElement.update.
+        """
+        if self._child is None:
+            if self.items_shared:
+                self.items = dict(self.items)
+                self.items_shared = False
+            self.items.update(items)
+            # the items may include new values for the array
+            self.value_index = None
+            self.touch()
+
+
+    def multiply_attach_locally(self, tree):
+        """
+        Makes tree the child of every node if they are leaves.  Used by
+        OptionsTreeElement.attach_to_leaves.
+        """
+        if self._child is None:
+            self._child = tree
+
+
+    def attach_locally(self, tree):
+        raise OptionsArrayException(
+            "can't attach separate elements to the nodes of a virtual "
+            "array; materialize it first")
+
+
+    def update_node_info(self):
+        """
+        The node information is created along with the nodes, so this
+        just makes sure that any cached leaves get regenerated.
+        """
+        self.touch()
+
+
+    def split_leaf_range(self, leaf_range):
+        """
+        Yields (node, leaf_range) pairs for the nodes whose subtrees
+        contain leaves in the given range, creating each node only as
+        it is needed.  Used by OptionsTreeElement.iter_leaves.
+        """
+        if leaf_range is None:
+            for i in xrange(len(self)):
+                yield self.create_node(i), None
+            return
+        start, stop, step = leaf_range
+        count = self.count_leaves_per_node()
+        if not count:
+            return
+        for i in xrange(start // count,
+                        min(len(self), (stop + count - 1) // count)):
+            offset = i * count
+            if start >= offset:
+                first = start
+            else:
+                first = start + -((start - offset) // step) * step
+            end = min(stop, offset + count)
+            if first < end:
+                yield self.create_node(i), (first - offset, end - offset, step)
+
+
+    def count_leaves_per_node(self):
+        """
+        Returns the number of leaves beneath each node, which is the
+        same for all of them.
+        """
+        if self._child is None:
+            return 1
+        return self._child.count_leaves()
+
+
+    def count_node_leaves(self):
+        return [self.count_leaves_per_node()] * len(self)
+
+
+    def split_leaf_index(self, index):
+        """
+        Converts a leaf index into the index of the node whose subtree
+        contains the leaf and the index of the leaf within that
+        subtree, which are all the same size.
+        """
+        count = self.count_leaves_per_node()
+        if not 0 <= index < count * len(self):
+            raise IndexError("leaf index out of range")
+        return divmod(index, count)
+
+
+    def leaf_offset(self, node_index):
+        return node_index * self.count_leaves_per_node()
+
+
+    def get_name_index(self):
+        """
+        Returns a dict mapping node names to lists of node indices,
+        worked out from the values.  The dict is built on first use.
+        """
+        if self.name_index is None:
+            self.name_index = {}
+            for i, node_name in enumerate(self.get_node_names()):
+                self.name_index.setdefault(node_name, []).append(i)
+        return self.name_index
+
+
+    def get_value_index(self):
+        """
+        Returns a dict mapping the values stored under the array name in
+        each node to lists of node indices.  The dict is built on first
+        use and discarded when the items change.
+        """
+        if self.value_index is None:
+            self.value_index = {}
+            if self.name in self.items:
+                # overrides the values in every node
+                try:
+                    self.value_index[self.items[self.name]] = \
+                        xrange(len(self))
+                except TypeError:
+                    # unhashable
+                    pass
+                return self.value_index
+            for i, value in enumerate(self.values):
+                try:
+                    self.value_index.setdefault(value, []).append(i)
+                except TypeError:
+                    # unhashable
+                    pass
+        return self.value_index
+
+
+    def get_value_spec(self):
+        return self.materialize().get_value_spec()
+
+
+    def own_node(self, index, memo=None):
+        raise OptionsArrayException(
+            "can't change the nodes of a virtual array; materialize it first")
+
+
+    def count_and_shape(self):
+        """
+        Returns the leaf count and shape of the present array's
+        subtree from the values cached on its child.  Used by
+        OptionsTreeElement.cache_shape.
+        """
+        if self._child is None or not len(self):
+            return len(self), (len(self),)
+        shape = self._child.subtree_shape
+        if shape is not None:
+            shape = (len(self),) + shape
+        return len(self) * self._child.leaf_count, shape
+
+
+    def merge_cached_leaves(self):
+        if self._child is None:
+            child_leaves = [None]
+        else:
+            child_leaves = self._child.leaf_cache[1]
+        result = []
+        for i in xrange(len(self)):
+            node = self.create_node(i)
+            result.extend(node.merge_options_dict(od, layered=True)
+                          for od in child_leaves)
+        return result
+
+
+    def prune_target(self, memo):
+        """
+        Returns a materialized copy of the present array, made once per
+        constrain, which is pruned in its place.  The present array is
+        returned instead if nothing is removed.  Used by
+        OptionsTreeElement.prune.
+        """
+        key = ('materialized', id(self))
+        if key not in memo:
+            # keep the present array alive, so that its id is not reused
+            memo[key] = (self, self.materialize())
+        return memo[key][1]
+
+
+    def match_children(self, other):
+        """
+        Pairs the nodes of materialized copies of the present array
+        and another virtual array.  Used by diff.
+        """
+        return self.materialize().match_children(other.materialize())
+
+
+    def append(self, item):
+        raise OptionsArrayException(
+            "can't add nodes to a virtual array; materialize it first")
+
+    def pop(self):
+        raise OptionsArrayException(
+            "can't remove nodes from a virtual array; materialize it first")
+
+    def extend(self, items):
+        raise OptionsArrayException(
+            "can't add nodes to a virtual array; materialize it first")
+
+    def insert_many(self, subscript, items):
+        raise OptionsArrayException(
+            "can't add nodes to a virtual array; materialize it first")
+
+    def remove_many(self, subscripts):
+        raise OptionsArrayException(
+            "can't remove nodes from a virtual array; materialize it first")
+
+    def __len__(self):
+        return len(self.values)
+
+
+    def __getitem__(self, subscript):
+        if isinstance(subscript, slice):
+            # return a virtual array with the selected values
+            result = self.shallow_copy()
+            result.values = slice_values(self.values, subscript)
+            result.node_names = None
+            result.name_index = None
+            result.value_index = None
+            result.leaf_count = None
+            result.touch()
+            return result
+        if isinstance(subscript, basestring):
+            indices = self.get_name_index().get(subscript)
+            if indices is None:
+                raise IndexError("no node named '{}'".format(subscript))
+            return self.create_node(indices[0])
+        index = subscript
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("list index out of range")
+        return self.create_node(index)
+
+
+    def __setitem__(self, subscript, value_or_values):
+        raise OptionsArrayException(
+            "can't change the nodes of a virtual array; materialize it first")
+
+    def __delitem__(self, subscript):
+        raise OptionsArrayException(
+            "can't remove nodes from a virtual array; materialize it first")
+
+
+def from_spec(spec):
+    """
+    Returns a tree built from a description returned by
+    OptionsTreeElement.to_spec, which may also be given as a JSON
+    string.  Shared subtrees are rebuilt once and shared again, and
+    the node information is rebuilt by each array.
+    """
+    if isinstance(spec, basestring):
+        spec = json.loads(spec)
+    if spec.get('opiter_spec') != SPEC_VERSION:
+        raise OptionsArrayException(
+            "unrecognised spec version: {}".format(spec.get('opiter_spec')))
+    elements = []
+    parent_counts = []
+    # the node information given to each node by an array, keyed by
+    # the node's id; see share_node_info
+    node_info_keys = {}
+
+    def refer(index):
+        # elements with more than one parent are shared; see
+        # OptionsTreeElement.own
+        parent_counts[index] += 1
+        element = elements[index]
+        if parent_counts[index] > 1:
+            element.shared = True
+        return element
+
+    def decode_items(items):
+        return dict((str(k), decode_value(v)) for k, v in items.iteritems())
+
+    # Nodes are copied from the attributes of a template node rather
+    # than constructed, which bypasses the usual inference of names
+    # and items and the checks made by OptionsNode.__setattr__.
+    template = OptionsNode('').__dict__
+
+    def create_node(name, items, tags, child):
+        od = OptionsDict()
+        dict.update(od, items)
+        attributes = dict(template)
+        attributes.update(name=name, tags=tags, _options_dict=od,
+                          _child=child, version=object())
+        node = InstanceType(OptionsNode, attributes)
+        od.set_node_info(node.create_info())
+        return node
+
+    def share_node_info(array):
+        # A node shared by several arrays is only copied if an array
+        # gives it different node information from the first, rather
+        # than by every array after the first (see
+        # OptionsArray.refresh_node_info).
+        names = array.get_node_names()
+        for i in range(len(array._nodes)):
+            key = (array.name, names, tuple(array.tags), i)
+            if node_info_keys.get(id(array._nodes[i])) == key:
+                continue
+            array.own_node(i)
+            node = array._nodes[i]
+            node.update_node_info(array.create_node_info(i))
+            node_info_keys[id(node)] = key
+
+    for entry in spec['elements']:
+        tags = decode_value(entry.get('tags', []))
+        items = decode_items(entry.get('items', {}))
+        child = refer(entry['child']) if 'child' in entry else None
+        if 'node' in entry:
+            element = create_node(decode_value(entry['node']), items, tags,
+                                  child)
+        elif entry.get('virtual'):
+            element = VirtualOptionsArray(
+                decode_value(entry['array']), decode_value(entry['values']),
+                name_format=decode_value(entry['name_format']), tags=tags)
+            element.items = items
+            element._child = child
+        else:
+            name = decode_value(entry['array'])
+            element = OptionsArray(name, [], tags=tags)
+            if 'nodes' in entry:
+                element._nodes = [refer(i) for i in entry['nodes']]
+                share_node_info(element)
+            else:
+                values = decode_value(entry['values'])
+                names = decode_value(entry.get('names')) or \
+                        ['{}'.format(v) for v in values]
+                for node_name, value in zip(names, values):
+                    node_items = dict(items)
+                    node_items[name] = value
+                    element._nodes.append(
+                        create_node(node_name, node_items, tags, child))
+                if child is not None and len(values) > 1:
+                    child.shared = True
+                element.update_node_info()
+        for hook_name in ['list_hooks', 'dict_hooks', 'item_hooks']:
+            if hook_name in entry:
+                setattr(element, hook_name,
+                        [decode_value(h) for h in entry[hook_name]])
+        elements.append(element)
+        parent_counts.append(0)
+    return elements[-1]
+
+
 class OptionsArrayFactory:
     """
     Provides an OptionsArray constructor with an alternative system
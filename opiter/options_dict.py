@@ -1,7 +1,8 @@
 from base import OptionsBaseException
 from node_info import NodeInfoException
 from formatters import SimpleFormatter, TreeFormatter
-from types import FunctionType
+from types import FunctionType, BuiltinFunctionType, ClassType, \
+    NoneType
 from string import Template
 from copy import deepcopy
 from warnings import warn
@@ -11,6 +12,12 @@ from pickle import dumps, PicklingError
 
 MissingDependencyExceptions = (KeyError, AttributeError, NodeInfoException)
 
+# values of these types are never modified in place, so copies of an
+# OptionsDict can share them
+IMMUTABLE_TYPES = frozenset([
+    NoneType, bool, int, long, float, complex, str, unicode,
+    FunctionType, BuiltinFunctionType, ClassType, type])
+
 
 class OptionsDictException(OptionsBaseException):
     pass
@@ -294,6 +301,32 @@ class OptionsDict(dict):
         acceptor.update(self)
         return acceptor, []
 
+
+    def __copy__(self):
+        # The generic implementation restores the items through
+        # __setitem__, which subclasses may override.
+        result = dict.__new__(self.__class__)
+        result.__dict__.update(self.__dict__)
+        result.__dict__['_node_info'] = list(self._node_info)
+        dict.update(result, self)
+        return result
+
+
+    def __deepcopy__(self, memo):
+        # Copying the items one by one through the generic
+        # implementation dominates collapse(), so immutable values and
+        # the keys are shared with the copy.  The node information is
+        # copied as a whole.
+        result = dict.__new__(self.__class__)
+        memo[id(self)] = result
+        for name, value in self.__dict__.iteritems():
+            result.__dict__[name] = deepcopy(value, memo)
+        for key, value in dict.iteritems(self):
+            if type(value) not in IMMUTABLE_TYPES:
+                value = deepcopy(value, memo)
+            dict.__setitem__(result, key, value)
+        return result
+
     
     def _update_from_dict(self, other, default_error):
         # update OptionsDict attributes
@@ -390,6 +423,113 @@ class OptionsDict(dict):
             return value
 
 
+class LayeredOptionsDict(OptionsDict):
+    """
+    An OptionsDict made from the items of another OptionsDict (the
+    layer beneath) without deep-copying all of them.  Values of the
+    types in IMMUTABLE_TYPES, which make up most options, are shared
+    with the layer, and only the others are deep-copied.  Many
+    LayeredOptionsDicts can therefore be made from one layer cheaply,
+    and none of them can change it, however its values are reached.
+    """
+    def __init__(self, layer={}):
+        OptionsDict.__init__(self)
+        try:
+            self._node_info = list(layer._node_info)
+        except AttributeError:
+            pass
+        memo = {}
+        for key, value in dict.iteritems(layer):
+            if type(value) not in IMMUTABLE_TYPES:
+                value = deepcopy(value, memo)
+            dict.__setitem__(self, key, value)
+
+
+class PartialOptionsDict:
+    """
+    Holds the items merged from the root of a tree down to a branch
+    node, so that a collapse(where=...) predicate can be tested before
+    the leaves are reached.  The keys that the predicate looks up are
+    recorded in _accessed_keys, and _all_keys_accessed is set if it
+    looks at the items as a whole, so that the caller can tell whether
+    items further down the tree could change the outcome.
+
+    Items are looked up much as in an OptionsDict, but this is not a
+    dict, so there is no way of getting at the items without being
+    seen, e.g. through dict(od).  Only item lookups by key are
+    recorded as such; anything else is passed on to an OptionsDict
+    holding all of the items and counts as looking at all of them.
+
+    Only references to the items are copied, and there is no node
+    information until the leaves are reached, so asking for it raises
+    a NodeInfoException.
+    """
+    def __init__(self, items={}):
+        if isinstance(items, PartialOptionsDict):
+            items = items._items
+        self._items = dict(items)
+        self._accessed_keys = set()
+        self._all_keys_accessed = False
+
+    def merge(self, items):
+        """
+        Adds the items defined by the next element down the tree,
+        without looking them up.
+        """
+        self._items.update(items)
+
+    def defines(self, key):
+        """
+        Returns True if key is among the items, without recording it
+        as looked up.  Used by Exclude.
+        """
+        return key in self._items
+
+    def __getitem__(self, key):
+        self._accessed_keys.add(key)
+        value = self._items[key]
+        if isinstance(value, FunctionType):
+            # dependent item, whose dependencies are recorded too
+            return value(self)
+        return value
+
+    def get(self, key, default=None):
+        self._accessed_keys.add(key)
+        return self._items.get(key, default)
+
+    def has_key(self, key):
+        self._accessed_keys.add(key)
+        return key in self._items
+
+    def __contains__(self, key):
+        return self.has_key(key)
+
+    def __getattr__(self, name):
+        if hasattr(OptionsDict, name):
+            # a method that sees the items as a whole
+            self._all_keys_accessed = True
+            whole = OptionsDict()
+            dict.update(whole, self._items)
+            return getattr(whole, name)
+        if name.startswith('_'):
+            raise AttributeError(name)
+        # attribute-style item lookup, as for an OptionsDict
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError("'{}'".format(name))
+
+    def get_node_info(self, collection_name=None):
+        raise NodeInfoException(
+            "node information is not available until a leaf is reached")
+
+    def get_string(self, *args, **kwargs):
+        raise NodeInfoException(
+            "node information is not available until a leaf is reached")
+
+    __str__ = get_string
+
+
 def dict_key_pairs(this_dict, key=None, recursive=True):
     """
     Generator that yields dict-key pairs for a given dict.  When
@@ -472,6 +612,38 @@ class Remove:
         if self.test(target_dict, key):
             del target_dict[key]
 
+
+
+class Exclude:
+    """
+    A constraint for product() and OptionsTreeElement.constrain, which
+    excludes any combination of options matching all of the given
+    items, e.g. Exclude(fluid='ethanol', velocity=0.04).
+    """
+    def __init__(self, **items):
+        self.items = items
+
+    def __call__(self, options_dict):
+        # Compare the items that are already defined first.  When
+        # applied to a partially merged dictionary, a mismatch can
+        # then be found without looking up the other items.  Failing
+        # that, the outcome depends on the undefined items, so each
+        # is looked up in a way that a PartialOptionsDict records.
+        if isinstance(options_dict, PartialOptionsDict):
+            defines = options_dict.defines
+        else:
+            defines = options_dict.__contains__
+        missing = []
+        for key, value in self.items.items():
+            if not defines(key):
+                missing.append(key)
+            elif options_dict[key] != value:
+                return False
+        missing = [key for key in missing if key not in options_dict]
+        if missing:
+            raise KeyError(missing[0])
+        return True
+
             
 def missing_dependencies(target_dict, key):
     try:
@@ -1,8 +1,8 @@
 from options_tree_elements import OptionsTreeElement, \
-    OptionsTreeElementException
+    OptionsTreeElementException, encode_value
 from node_info import NodeInfo, Position
-from options_dict import OptionsDict
-from copy import deepcopy
+from options_dict import OptionsDict, LayeredOptionsDict
+from copy import copy, deepcopy
 from warnings import warn
 
 
@@ -91,7 +91,10 @@ class OptionsNode(OptionsTreeElement):
         
         # instantiate the options dict and update from both args (with
         # arg2 taking precedence over arg1)
-        self.options_dict = self.create_options_dict()
+        self._options_dict = self.create_options_dict()
+        self.options_dict_shared = False
+        # see touch_if_changed
+        self.items_snapshot = None
         self.update_options_dict_general(arg2, node_key)
         self.update_options_dict_general(arg1, node_key)
 
@@ -100,7 +103,10 @@ class OptionsNode(OptionsTreeElement):
         if child is not None and not isinstance(child, OptionsTreeElement):
             raise OptionsNodeException(
                 "child argument must be an OptionsTreeElement (or None)")
-        self.child = child
+        if child is not None:
+            # the client holds the child
+            child.expose(self)
+        self._child = child
 
         
     def set_name_general(self, arg, name_format):
@@ -143,28 +149,28 @@ class OptionsNode(OptionsTreeElement):
         # arg.  Tolerate failures silently since the arg may not
         # be intended for this purpose.
         try:
-            self.options_dict.update(arg)
+            self._options_dict.update(arg)
         except:
             pass
         
         # Try and infer a representative value to be stored under
         # node_key, if one doesn't already exist
-        if node_key and node_key not in self.options_dict:
+        if node_key and node_key not in self._options_dict:
             if hasattr(arg, 'name'):
                 # if the arg is another OptionsNode or something with
                 # a 'name' attribute, make that name the
                 # representative value
-                self.options_dict.update({node_key: arg.name})
+                self._options_dict.update({node_key: arg.name})
                 
             elif hasattr(arg, '__name__'):
                 # if the arg is a class, make its name the
                 # representative value
-                self.options_dict.update({node_key: arg.__name__})
+                self._options_dict.update({node_key: arg.__name__})
             
             elif not hasattr(arg, '__iter__'):
                 # for all other non-iterable types, store the value
                 # directly
-                self.options_dict.update({node_key: arg})
+                self._options_dict.update({node_key: arg})
 
         
     def create_options_dict(self, items={}):
@@ -184,72 +190,273 @@ class OptionsNode(OptionsTreeElement):
         return OrphanNodeInfo(self.name, tags=self.tags)
 
         
-    def collapse(self):
+    def is_leaf(self):
+        return self._child is None
+
+
+    def get_options_dict(self):
+        return self._options_dict
+
+
+    def merge_options_dict(self, od, layered=False):
         """
-        Returns a list of options dictionaries corresponding to the leaves
-        in the the present tree structure.  Each dictionary is the
-        result of a merge from the root, through the branch nodes, to
-        the corresponding leaf.
+        Returns a copy of the node's options dictionary, updated with
+        od if a dictionary has come up from a leaf beneath the node.
+        Used by OptionsTreeElement.iter_leaves and
+        OptionsTreeElement.leaf.
         """
-        try:
-            # recurse 
-            result = []
-            for sub_od in self.child.collapse():
-                # copy, inform and update the present dictionary with
-                # each element in the result of the recursion
-                od = deepcopy(self.options_dict)
-                od.update(sub_od)
-                result.append(od)
-            
-        except AttributeError:
-            # this is a leaf, so just return the current options
-            # dictionary as a one-element list
-            result = [deepcopy(self.options_dict)]
+        result = self.copy_options_dict(layered)
+        if od is not None:
+            result.update(od)
+        return result
+
+
+    def split_leaf_range(self, leaf_range):
+        """
+        Returns a list of (child, leaf_range) pairs for the children
+        containing the given range of leaves.  Used by
+        OptionsTreeElement.iter_leaves.
+        """
+        if self._child is None:
+            return []
+        return [(self._child, leaf_range)]
+
+
+    def child_with_leaf(self, index):
+        """
+        Returns the child containing the given leaf and the index of
+        the leaf within it.  Used by OptionsTreeElement.leaf.
+        """
+        return self._child, index
 
-        self.apply_hooks(result)
+
+    def replace_children(self, children):
+        """
+        Returns a shallow copy of the present node with the given
+        child.  Used by OptionsTreeElement.prune.
+        """
+        result = self.copy_element()
+        child, = children
+        result._child = self.share(child)
+        # the copied leaf count no longer applies
+        result.leaf_count = None
         return result
+
+
+    def match_children(self, other):
+        """
+        Pairs the present node's child with that of another node.
+        Returns a list holding the (child, other_child) pair if any, or
+        None if only one of the nodes is a leaf.  Used by diff and
+        compare_locally.
+        """
+        if (self._child is None) != (other._child is None):
+            return None
+        if self._child is None:
+            return []
+        return [(self._child, other._child)]
+
+
+    def compare_locally(self, other):
+        """
+        Returns None if other is not a node with the same name and
+        options dictionary as the present node, or else the pair of
+        children to compare next (see match_children).  Used by
+        OptionsTreeElement.__eq__.
+        """
+        if not isinstance(other, OptionsNode) or \
+           self.name != other.name or \
+           self._options_dict != other._options_dict:
+            return None
+        return self.match_children(other)
+
+
+    def get_spec(self, indices):
+        """
+        Returns a description of the present node, given the indices of
+        the descriptions of its descendants.  Used by
+        OptionsTreeElement.to_spec.
+        """
+        spec = {'node': self.name,
+                'items': dict((k, encode_value(v))
+                              for k, v in self._options_dict.iteritems())}
+        if self._child is not None:
+            spec['child'] = indices[id(self._child)]
+        if self.tags:
+            spec['tags'] = list(self.tags)
+        return spec
+
+
+    def count_and_shape(self):
+        """
+        Returns the leaf count and shape of the present node's subtree
+        from the values cached on its child.  Used by
+        OptionsTreeElement.cache_shape.
+        """
+        if self._child is None:
+            return 1, ()
+        return self._child.leaf_count, self._child.subtree_shape
+
+
+    def match_name(self, name, node_separator):
+        """
+        Returns the child and the rest of the string identifier name
+        after the present node's name, as a (child, name, leaf offset)
+        tuple in a list, or an empty list if name doesn't start with
+        the node's name.  The child is None if the node is the leaf
+        being looked for.  Used by OptionsTreeElement.find_leaf_by_name.
+        """
+        if not self.name:
+            # nameless nodes don't contribute to the identifier
+            remainder = name
+        elif name == self.name:
+            remainder = ''
+        elif name.startswith(self.name + node_separator):
+            remainder = name[len(self.name) + len(node_separator):]
+        else:
+            return []
+        if self._child is None:
+            return [] if remainder else [(None, '', 0)]
+        return [(self._child, remainder, 0)]
+
+
+    def match_items(self, items):
+        """
+        Returns the child as a (child, leaf offset) pair in a list,
+        where the child is None if the node is a leaf.  Used by
+        OptionsTreeElement.find_leaf_by_items.
+        """
+        return [(self._child, 0)]
+
+
+    def copy_options_dict(self, layered=False):
+        """
+        Returns a deep copy of the node's options dictionary or, if
+        layered is True, a LayeredOptionsDict that shares its immutable
+        values.
+        """
+        if layered:
+            return LayeredOptionsDict(self._options_dict)
+        else:
+            return deepcopy(self._options_dict)
     
             
-    def multiply_attach(self, tree):
+    def copy_contents(self, memo):
         """
-        Appends a copy of tree to each leaf node in the present
-        tree structure.
+        Replaces the options dictionary with a deep copy.  Used by
+        OptionsTreeElement.__deepcopy__, which copies the child.
         """
-        try:
-            # recurse
-            self.child.multiply_attach(tree)
-        except AttributeError:
-            self.child = deepcopy(tree)
-            self.child.update_node_info()
+        self._options_dict = deepcopy(self._options_dict, memo)
 
             
-    def attach(self, tree):
+    def own_child(self, memo=None):
         """
-        Appends a copy of each root node in the tree argument (or
-        whichever elements get traversed during iteration) to a
-        corresponding leaf node in the present tree.  Returns the
-        depleted source tree.
+        Makes sure that the child is not shared with any other parent, in
+        preparation for modifying it.  Returns True if the child needs
+        modifying.  See OptionsTreeElement.own.
         """
-        if not tree:
-            # no more elements to attach, so exit early
-            return None
-        elif not self.child:
-            # This is a leaf.  Copy and split the tree, making the
-            # first element the child of this node and returning the
-            # rest to the client.
-            try:
-                # polymorphic implementation, needed for handling
-                # embedded node info correctly
-                self.child, remainder = tree.donate_copy(self.child)
-                self.child.update_node_info()
-                return remainder
-            except AttributeError:
-                # manual implementation, for native iterables
-                self.child = deepcopy(tree[0])
-                return tree[1:]
+        if self._child is None:
+            return True
+        self._child, modify = self.own(self._child, memo)
+        return modify
+
+
+    def own_child_at(self, index, memo=None):
+        """
+        Used by OptionsTreeElement.walk; index can only be 0.
+        """
+        return self.own_child(memo)
+
+
+    def set_child_at(self, index, element):
+        """
+        Used by OptionsTreeElement.shallow_copy; index can only be 0.
+        """
+        self._child = element
+
+
+    def own_options_dict(self, values=True):
+        """
+        Makes sure that the options dictionary is not shared with a
+        shallow copy of the present node, in preparation for
+        modifying it.  If values is False, the dictionary is copied
+        but the values it holds go on being shared, which is enough
+        for giving it new node information or replacing items.
+        """
+        if not self.options_dict_shared:
+            return
+        if values:
+            self._options_dict = deepcopy(self._options_dict)
+            self.options_dict_shared = False
+        else:
+            # the values are still shared
+            self._options_dict = copy(self._options_dict)
+
+
+    def copy_element(self):
+        result = OptionsTreeElement.copy_element(self)
+        if self.exposed:
+            # the client may modify the options dictionary directly
+            result._options_dict = deepcopy(self._options_dict)
+        else:
+            # the options dictionary will be copied when either node
+            # modifies it
+            self.options_dict_shared = True
+            result.options_dict_shared = True
+        return result
+
+
+    def __getstate__(self):
+        state = OptionsTreeElement.__getstate__(self)
+        state['items_snapshot'] = None
+        return state
+
+
+    def expose(self, parent=None):
+        # the client may modify the options dictionary directly
+        self.own_options_dict()
+        if self.items_snapshot is None:
+            # changes from now on are looked for; see touch_if_changed
+            self.items_snapshot = dict.copy(self._options_dict)
+        return OptionsTreeElement.expose(self, parent)
+
+
+    def peek_children(self):
+        if self._child is None:
+            return []
         else:
+            return [self._child]
+
+            
+    def attach_locally(self, tree):
+        """
+        If the present node is a leaf, copies and splits the tree,
+        making the first element the child of this node and returning
+        the rest.  Used by OptionsTreeElement.attach.
+        """
+        if self._child:
             # keep going
-            return self.child.attach(tree)
+            return tree
+        if hasattr(tree, 'donate_copy'):
+            # polymorphic implementation, needed for handling
+            # embedded node info correctly
+            self._child, remainder = tree.donate_copy(self._child)
+            self._child.update_node_info()
+        else:
+            # manual implementation, for native iterables
+            self._child = deepcopy(tree[0])
+            remainder = tree[1:]
+        self.shape_changed()
+        return remainder
+
+
+    def multiply_attach_locally(self, tree):
+        """
+        Makes tree the child of the present node if it is a leaf.  Used
+        by OptionsTreeElement.attach_to_leaves.
+        """
+        if self._child is None:
+            self._child = tree
 
 
     def donate_copy(self, acceptor):
@@ -261,21 +468,15 @@ class OptionsNode(OptionsTreeElement):
         return acceptor, []
 
         
-    def count_leaves(self):
-        if self.child:
-            return self.child.count_leaves()
-        else:
-            return 1
-
-                
-    def update(self, items):
+    def update_locally(self, items):
         """
-        Updates the leaf dictionaries with items.
+        Updates the options dictionary with items if the present node
+        is a leaf.  Used by OptionsTreeElement.update.
         """
-        if self.child:
-            self.child.update(items)
-        else:
-            self.options_dict.update(items)
+        if not self._child:
+            self.own_options_dict()
+            self._options_dict.update(items)
+            self.touch()
 
     
     def update_node_info(self, new_node_info=None):
@@ -288,34 +489,99 @@ class OptionsNode(OptionsTreeElement):
         if not new_node_info:
             new_node_info = self.create_info()
         # delegate
+        self.own_options_dict(values=False)
         try:
-            self.options_dict.set_node_info(new_node_info)
+            self._options_dict.set_node_info(new_node_info)
         except AttributeError:
-            raise OptionsNodeException(str(type(self.options_dict)) + ' '+\
-                                       repr(self.options_dict))
+            raise OptionsNodeException(str(type(self._options_dict)) + ' '+\
+                                       repr(self._options_dict))
+        self.touch()
+
+
+    def get_child(self):
+        """
+        Returns the child, which the client may go on to modify, so it
+        is replaced with a copy first if it is shared (see own).
+        """
+        if self._child is None:
+            return None
+        self.own_child()
+        return self._child.expose(self)
+
+    child = property(get_child)
+
+    def expose_options_dict(self):
+        """
+        Returns the options dictionary, which the client may go on to
+        modify, so it is no longer shared with any copy of the node.
+        The node counts as changed, and is checked for changes to its
+        items whenever its versions are refreshed (see
+        touch_if_changed), so that cached leaves get regenerated.
+        """
+        self.expose()
+        self.touch()
+        return self._options_dict
+
+    options_dict = property(expose_options_dict)
+
+    def __setattr__(self, name, value):
+        # OptionsNode is an old-style class, so assigning to the child
+        # and options_dict properties has to be handled here
+        if name == 'child':
+            if value is not None:
+                # the client holds the child
+                value.expose(self)
+            self.__dict__['_child'] = value
+            self.shape_changed()
+        elif name == 'options_dict':
+            self.__dict__['_options_dict'] = value
+            self.options_dict_shared = False
+            self.expose()
+            self.touch()
+        else:
+            OptionsTreeElement.__setattr__(self, name, value)
+
+
+    def touch_if_changed(self):
+        """
+        Touches the present node if it has been exposed and the items
+        of its options dictionary have been set or removed since the
+        last call, as the client may hold on to the dictionary.
+        Values that are modified in place can't be detected this way,
+        so the dictionary should be fetched again through
+        options_dict before doing that.  Used by
+        OptionsTreeElement.refresh_versions.
+        """
+        if not self.exposed:
+            return
+        items = self._options_dict
+        snapshot = self.items_snapshot
+        if snapshot is None or len(snapshot) != len(items) or \
+           any(snapshot.get(key, snapshot) is not value
+               for key, value in dict.iteritems(items)):
+            self.touch()
+            self.items_snapshot = dict.copy(items)
 
-        
-    def __eq__(self, other):
-        result = isinstance(other, OptionsNode)
-        if result:
-            result *= self.name == other.name
-            result *= self.options_dict == other.options_dict
-            result *= self.child == other.child
-        return result
 
     def __getitem__(self, subscript):
-        if self.child:
+        if self._child:
+            # the client may go on to modify the item
             return self.child[subscript]
         else:
             raise IndexError('no iterable children')
 
     def __setitem__(self, subscript, value_or_values):
-        if self.child:
-            self.child[subscript] = value_or_values
+        if self._child:
+            self.own_child()
+            self._child[subscript] = value_or_values
+            # the child isn't exposed, so it can't tell the node
+            self.shape_changed()
 
     def __delitem__(self, subscript):
-        if self.child:
-            del self.child[subscript]
+        if self._child:
+            self.own_child()
+            del self._child[subscript]
+            self.shape_changed()
         else:
             raise IndexError('no iterable children')
 
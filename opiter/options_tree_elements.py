@@ -1,33 +1,357 @@
 from base import OptionsBaseException
-from operator import mul
-from copy import deepcopy
+from options_dict import PartialOptionsDict, LayeredOptionsDict, \
+    MissingDependencyExceptions, Sequence
+from leaf_snapshot import write_snapshot
+from copy import copy, deepcopy
+from weakref import ref
+from types import FunctionType, BuiltinFunctionType, ClassType
+from pickle import dumps, loads
+from base64 import b64encode, b64decode
+import sys
 
 
-def product(iterable):
+def product(iterable, constraints=None):
     """
     Works like the sum function, but is multiplicative instead of
     additive.  Might be useful for factorial design of experiments.
+    If the design is sparse, functions such as Exclude can be given as
+    constraints to remove combinations from the product; see
+    OptionsTreeElement.constrain.
+
+    The factors are multiplied from the right, so that each one is
+    attached just once, beneath the leaves of the factor before it,
+    and all those leaves share the partial product.  The time taken
+    is then proportional to the total size of the factors rather
+    than to the number of leaves in the result, which are only
+    generated as the product is collapsed.
     """
-    return reduce(mul, iterable, 1)
+    factors = list(iterable)
+    if not factors:
+        return 1
+    # 1 * factor copies the factor, as reduce(mul, factors, 1) would
+    result = 1 * factors[-1]
+    for factor in reversed(factors[:-1]):
+        result = factor * result
+    if constraints:
+        result = result.constrain(constraints)
+    return result
 
 
 def nonmutable(method):
     """
     Decorator that calls method but provides a new object instead of
     modifying the current one.  This means the call can be inlined
-    neatly without mutating the operands.
+    neatly without mutating the operands.  The new object starts out
+    as a shallow copy, and only the elements that the method goes on
+    to modify are copied (see OptionsTreeElement.own), so the result
+    shares everything else with the current object.  Elements that
+    the client has been handed are never shared (see
+    OptionsTreeElement.expose), and nor is anything belonging to the
+    current object itself, which the client holds.
     """
     def decorator(self, other):
-        result = deepcopy(self)
+        result = self.expose().shallow_copy()
         method(result, other)
         return result
     return decorator
 
 
+def diff(old_tree, new_tree):
+    """
+    Compares two trees, e.g. before and after a sweep is extended, and
+    returns lists of the leaves that were added and removed, in the
+    order that they are found in the new and old trees respectively,
+    and a dict of the leaves that were modified along with the keys
+    whose values changed.  Leaves are identified by their get_string()
+    identifiers, so the nodes of arrays are matched by name.  Items
+    are compared as they are stored, so a dependent item is only
+    reported if its function changes.
+
+    The trees are walked in parallel, and pairs of subtrees that are
+    identical (e.g. shared between the two trees) and inherit the same
+    items are skipped.  Where the structures diverge, e.g. a leaf has
+    become a branch node, the leaves beneath are compared in full.  So
+    are the whole trees if they have hooks, which could depend on
+    anything.
+    """
+    added, removed, modified = [], [], {}
+
+    def compare_leaves(old, new, old_path, new_path):
+        old_ods = [(od.get_string(), od)
+                   for od in iter_path_leaves(old, old_path)]
+        new_ods = [(od.get_string(), od)
+                   for od in iter_path_leaves(new, new_path)]
+        old_by_name = dict(old_ods)
+        new_by_name = dict(new_ods)
+        for name, od in new_ods:
+            if name not in old_by_name:
+                added.append(name)
+                continue
+            keys = get_changed_keys(old_by_name[name], od)
+            if keys:
+                modified[name] = keys
+        removed.extend(name for name, _ in old_ods
+                       if name not in new_by_name)
+
+    if old_tree.map_subtree_keys()[id(old_tree)][1] or \
+       new_tree.map_subtree_keys()[id(new_tree)][1]:
+        compare_leaves(old_tree, new_tree, None, None)
+        return added, removed, modified
+
+    # Each frame holds a pair of elements, either of which may be None
+    # if the other has no counterpart, the paths leading to them (see
+    # iter_path_leaves) and the items merged down to them.
+    memo = {}
+    stack = [(old_tree, new_tree, None, None, {}, {})]
+    while stack:
+        old, new, old_path, new_path, old_items, new_items = stack.pop()
+        if old is None:
+            added.extend(od.get_string()
+                         for od in iter_path_leaves(new, new_path))
+            continue
+        if new is None:
+            removed.extend(od.get_string()
+                           for od in iter_path_leaves(old, old_path))
+            continue
+        if old.__class__ is not new.__class__:
+            compare_leaves(old, new, old_path, new_path)
+            continue
+        if old.get_options_dict() is not None:
+            if str(old) != str(new):
+                compare_leaves(old, new, old_path, new_path)
+                continue
+            old_items = dict(old_items)
+            dict.update(old_items, old.get_options_dict())
+            new_items = dict(new_items)
+            dict.update(new_items, new.get_options_dict())
+        if old_items == new_items and same_subtree(old, new, memo):
+            continue
+        pairs = old.match_children(new)
+        if pairs is None:
+            compare_leaves(old, new, old_path, new_path)
+            continue
+        if old.is_leaf():
+            keys = get_changed_keys(old_items, new_items)
+            if keys:
+                od, = iter_path_leaves(new, new_path)
+                modified[od.get_string()] = keys
+            continue
+        for old_child, new_child in reversed(pairs):
+            stack.append((old_child, new_child, (old, old_path),
+                          (new, new_path), old_items, new_items))
+    return added, removed, modified
+
+
+def get_changed_keys(old_items, new_items):
+    """
+    Returns a sorted list of the keys whose raw values differ between
+    two dicts, including keys that only one of them has.  Used by
+    diff.
+    """
+    result = []
+    for k in set(old_items.keys()) | set(new_items.keys()):
+        if dict.__contains__(old_items, k) != \
+           dict.__contains__(new_items, k) or \
+           dict.get(old_items, k) != dict.get(new_items, k):
+            result.append(k)
+    return sorted(result)
+
+
+def iter_path_leaves(element, path):
+    """
+    Yields the merged options dictionaries for the leaves beneath
+    element, as they would appear when collapsing the root of path.
+    The path is either None or a (parent, path) pair, so that it can
+    be extended without copying.  Hooks are not applied.  Used by
+    diff.
+    """
+    for od in element.iter_leaves(layered=True):
+        rest = path
+        while rest is not None:
+            parent, rest = rest
+            od = parent.merge_options_dict(od, layered=True)
+        yield od
+
+
+def same_subtree(old, new, memo):
+    """
+    Returns True if the subtrees beneath old and new hold the same
+    names, items and hooks in the same arrangement.  The memo holds the
+    result for each pair of elements, keyed by their ids, so that
+    shared subtrees are only compared once.  Used by diff.
+    """
+    # the memo also keeps the elements alive, so that their ids are
+    # not reused by any that are created on demand
+    stack = [(old, new)]
+    while stack:
+        a, b = stack[-1]
+        key = (id(a), id(b))
+        if key in memo:
+            stack.pop()
+            continue
+        if a is b:
+            memo[key] = (True, a, b)
+            stack.pop()
+            continue
+        a_children = a.peek_children()
+        b_children = b.peek_children()
+        if a.__class__ is not b.__class__ or str(a) != str(b) or \
+           len(a_children) != len(b_children) or \
+           not a.has_same_items(b) or \
+           (a.list_hooks, a.dict_hooks, a.item_hooks) != \
+           (b.list_hooks, b.dict_hooks, b.item_hooks):
+            memo[key] = (False, a, b)
+            stack.pop()
+            continue
+        pairs = zip(a_children, b_children)
+        pending = [(c, d) for c, d in pairs if (id(c), id(d)) not in memo]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        memo[key] = (all(memo[(id(c), id(d))][0] for c, d in pairs), a, b)
+    return memo[(id(old), id(new))][0]
+
+
+def hash_items(items):
+    """
+    Returns a hash of the items in a dict that is consistent with dict
+    equality, regardless of order.  Unhashable values are left out, so
+    only their keys contribute.
+    """
+    hashes = []
+    for key, value in dict.iteritems(items):
+        try:
+            hashes.append(hash((key, value)))
+        except TypeError:
+            hashes.append(hash(key))
+    return hash(frozenset(hashes))
+
+
 class OptionsTreeElementException(OptionsBaseException):
     pass
 
 
+def get_used_values(partial, keys):
+    """
+    Returns the raw values of the given keys in the
+    PartialOptionsDict partial, or all of its items if keys is None.
+    Used by OptionsTreeElement.prune.
+    """
+    items = partial._items
+    if keys is None:
+        return dict(items)
+    return [(k in items, items.get(k)) for k in sorted(keys)]
+
+
+def unlink_path(path):
+    """
+    Converts a path held as a linked list of (element, path) pairs,
+    ending at the innermost element, into a list of the elements
+    starting from the outermost.  Used by OptionsTreeElement.locate.
+    """
+    result = []
+    while path is not None:
+        el, path = path
+        result.append(el)
+    result.reverse()
+    return result
+
+
+def merge_path(path, od, layered):
+    """
+    Merges the options dictionaries of the elements in path, from the
+    last to the first, into od (which is None at a leaf), applying
+    each element's dict hooks in turn.  Used by OptionsTreeElement.leaf
+    and OptionsTreeElement.locate.
+    """
+    for el in reversed(path):
+        od = el.merge_options_dict(od, layered)
+        el.apply_dict_hooks(od)
+    return od
+
+
+# identifies the format written by OptionsTreeElement.to_spec
+SPEC_VERSION = 1
+
+
+def encode_value(value):
+    """
+    Converts an item value or hook to a form that can be written out
+    as JSON, for OptionsTreeElement.to_spec.  Numbers, str, None and
+    lists are kept as they are, and anything else is wrapped in a
+    dict with a single key saying how to decode it (see
+    decode_value): unicode is marked as such, since the json module
+    reads every string back as unicode, dicts and tuples are encoded
+    recursively, functions and classes are referred to by module and
+    name, and other objects are pickled.
+    """
+    if value is None or type(value) in (bool, int, long, float, str):
+        return value
+    if type(value) is unicode:
+        return {'__unicode__': value}
+    if type(value) is list:
+        return [encode_value(v) for v in value]
+    if type(value) is tuple:
+        return {'__tuple__': [encode_value(v) for v in value]}
+    if type(value) is dict and all(type(k) is str for k in value):
+        return {'__dict__': dict((k, encode_value(v))
+                                 for k, v in value.iteritems())}
+    if type(value) is xrange:
+        # an xrange's arguments aren't accessible, but can be worked
+        # out from its values
+        start = value[0] if value else 0
+        step = value[1] - value[0] if len(value) > 1 else 1
+        return {'__range__': [start, start + len(value) * step, step]}
+    if isinstance(value, (FunctionType, BuiltinFunctionType, ClassType,
+                          type)):
+        module = getattr(value, '__module__', None)
+        if getattr(sys.modules.get(module), value.__name__, None) \
+           is not value:
+            # e.g. a lambda or nested function
+            raise OptionsTreeElementException(
+                "can't refer to {} by name; only module-level functions "
+                "and classes can be written to a spec".format(value))
+        return {'__ref__': '{}:{}'.format(module, value.__name__)}
+    try:
+        return {'__pickle__': b64encode(dumps(value, 2))}
+    except Exception as e:
+        raise OptionsTreeElementException(
+            "can't write {} to a spec: {}".format(repr(value), e))
+
+
+def decode_value(value):
+    """
+    Reverses encode_value.  Unmarked strings were str, so they're
+    converted back from the unicode the json module turns them into.
+    Used by from_spec.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [decode_value(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    (tag, content), = value.items()
+    if tag == '__unicode__':
+        return content
+    if tag == '__tuple__':
+        return tuple(decode_value(v) for v in content)
+    if tag == '__dict__':
+        return dict((decode_value(k), decode_value(v))
+                    for k, v in content.iteritems())
+    if tag == '__range__':
+        return xrange(*content)
+    if tag == '__ref__':
+        module, name = str(content).split(':')
+        __import__(module)
+        return getattr(sys.modules[module], name)
+    if tag == '__pickle__':
+        return loads(b64decode(content))
+    raise OptionsTreeElementException(
+        "unrecognised value in spec: {}".format(repr(value)))
+
+
 class OptionsTreeElement:
     """
     Abstract class to be inherited by OptionsArray and OptionsNode.
@@ -40,10 +364,322 @@ class OptionsTreeElement:
         self.list_hooks = list_hooks
         self.dict_hooks = dict_hooks
         self.item_hooks = item_hooks
+        # set when the element has more than one parent; see own()
+        self.shared = False
+        # set once the element has been handed to the client, after
+        # which it is never shared; see expose()
+        self.exposed = False
+        # weak references to the parents that the element was exposed
+        # by, keyed by their ids; see shape_changed
+        self.parents = None
+        # see cache_shape
+        self.leaf_count = None
+        self.subtree_shape = None
+        self.list_hooks_below = False
+        # see refresh_versions, cache_leaves and collapse
+        self.version = object()
+        self.subtree_version = None
+        self.subtree_key = None
+        self.leaf_cache = None
+        self.collapse_memo = None
+        # see refresh_hashes
+        self.hash_cache = None
+
+    def __setattr__(self, name, value):
+        # Assigning list hooks changes which leaves can be found
+        # without collapsing; see has_list_hooks_below.  (The hooks
+        # should therefore be assigned rather than modified in place.)
+        self.__dict__[name] = value
+        if name == 'list_hooks' and 'leaf_count' in self.__dict__:
+            self.shape_changed()
 
     @classmethod
     def another(Class, *args, **kwargs):
         return Class(*args, **kwargs)
+
+    def shallow_copy(self):
+        """
+        Returns a copy of the present element that refers to the same
+        children, which get flagged as shared.  A child that the
+        client has been handed can't be shared (see expose), so the
+        copy refers to a shallow copy of it instead, made in the same
+        way.
+        """
+        result = self.copy_element()
+        stack = [(self, result)]
+        while stack:
+            original, copied = stack.pop()
+            for i, el in enumerate(original.peek_children()):
+                if el.exposed:
+                    el_copy = el.copy_element()
+                    copied.set_child_at(i, el_copy)
+                    stack.append((el, el_copy))
+                else:
+                    el.shared = True
+        return result
+
+    def copy_element(self):
+        """
+        Returns a copy of the present element alone, which refers to
+        the same children without flagging them as shared.  Used by
+        shallow_copy and replace_children.  Subclasses copy any
+        containers that they modify in place.
+        """
+        result = copy(self)
+        result.shared = False
+        # the copy starts out with the same contents, so it can carry
+        # on using the caches
+        result.leaf_cache = self.leaf_cache
+        result.collapse_memo = self.collapse_memo
+        return result
+
+    @staticmethod
+    def share(element):
+        """
+        Returns element flagged as shared, ready to be referred to by
+        another parent as well as its current one, or a shallow copy
+        of it if the client has been handed it (see expose).
+        """
+        if element.exposed:
+            return element.shallow_copy()
+        element.shared = True
+        return element
+
+    def expose(self, parent=None):
+        """
+        Records that the present element is being handed to the
+        client, who may hold on to it and modify it, and returns it.
+        From then on the element is never shared with another parent
+        (see share), so it is never replaced by a copy either (see
+        own), and changes made to it only show up where it was found.
+        The parent it was found in, if any, is remembered so that
+        changes to its shape reach the parent's cache; see
+        shape_changed.
+        """
+        self.exposed = True
+        if parent is not None:
+            if self.parents is None:
+                self.parents = {}
+            self.parents[id(parent)] = ref(parent)
+        return self
+
+    def __getstate__(self):
+        # Leave the caches behind when copying or pickling, as they
+        # can be much bigger than the tree itself.  Copies haven't
+        # been handed to the client.
+        state = self.__dict__.copy()
+        state['leaf_cache'] = None
+        state['collapse_memo'] = None
+        state['exposed'] = False
+        state['parents'] = None
+        return state
+
+    def __deepcopy__(self, memo):
+        # The generic implementation copies every attribute, but the
+        # names, tags and hooks are never modified in place, and the
+        # versions can carry on identifying the same contents.  So
+        # these are shared with the copy, and only the items and
+        # children are copied; see copy_contents.  The children are
+        # copied with an explicit stack, so that deep trees don't
+        # exceed the recursion limit.
+        result = copy(self)
+        memo[id(self)] = result
+        stack = [result]
+        while stack:
+            copied = stack.pop()
+            copied.copy_contents(memo)
+            for i, el in enumerate(copied.peek_children()):
+                el_copy = memo.get(id(el))
+                if el_copy is None:
+                    el_copy = copy(el)
+                    memo[id(el)] = el_copy
+                    stack.append(el_copy)
+                copied.set_child_at(i, el_copy)
+        return result
+
+    def touch(self):
+        """
+        Records that the items or node information held by the
+        present element have changed, so that any leaves cached on it
+        or on its ancestors get regenerated; see cache_leaves.
+        """
+        self.version = object()
+
+    def get_children(self):
+        """
+        Returns a list of the present element's child elements, which
+        the client may go on to modify.  Shared children are replaced
+        with copies first; see own and expose.
+        """
+        for i in range(len(self.peek_children())):
+            self.own_child_at(i)
+        return [child.expose(self) for child in self.peek_children()]
+
+    def touch_if_changed(self):
+        """
+        Touches the present element if the client may have changed it
+        without its knowledge; see refresh_versions.
+        """
+        pass
+
+    def peek_children(self):
+        """
+        Returns a list of the present element's child elements as they
+        are, possibly shared with other parents.  Used internally, by
+        methods that don't modify the children.
+        """
+        return []
+
+    def is_leaf(self):
+        """
+        Returns True if the present element is a leaf node.
+        """
+        return False
+
+    def has_hooks(self):
+        return bool(self.list_hooks or self.dict_hooks or self.item_hooks)
+
+    def get_options_dict(self):
+        """
+        Returns the options dictionary held by the present element, if
+        any.
+        """
+        return None
+
+    def get_local_keys(self):
+        """
+        Returns the item keys defined by the present element itself,
+        as opposed to its descendants.  Used by map_subtree_keys.
+        """
+        od = self.get_options_dict()
+        if od is None:
+            return []
+        return od.keys()
+
+    def has_same_items(self, other):
+        """
+        Returns True if the present element defines the same items as
+        other, which is of the same class, disregarding node
+        information and descendants.  Used by same_subtree.
+        """
+        od = self.get_options_dict()
+        return od is None or dict.__eq__(od, other.get_options_dict())
+
+    def merge_options_dict(self, od, layered=False):
+        """
+        Merges the options dictionary od, which comes from a leaf
+        beneath the present element, with anything the present
+        element contributes.  od is None when the present element is
+        itself the leaf.
+        """
+        return od
+
+    def attach_locally(self, tree):
+        """
+        Attaches to the present element whatever it needs from tree
+        during attach(), and returns the remainder of tree.
+        """
+        return tree
+
+    def update_locally(self, items):
+        """
+        Updates whatever the present element holds during update().
+        """
+        pass
+
+    def multiply_attach_locally(self, tree):
+        """
+        Makes tree the child of the present element if it is a leaf,
+        during multiply_attach().
+        """
+        pass
+
+    def walk(self, modify=False, memo=None):
+        """
+        Yields the present element and the elements beneath it in
+        depth-first order, using an explicit stack rather than
+        recursion so that very deep trees can be traversed.  The
+        children of each element are looked up before the element is
+        yielded, and any that get replaced while the element is being
+        visited (e.g. by attaching a new child to a leaf) are not
+        walked.
+
+        If modify is True, each child is passed through own() via its
+        parent's own_child_at method before it is yielded.  Children
+        that have already been modified in the same operation (see
+        the memo argument of own()) are skipped, along with their
+        descendants.
+        """
+        if not modify:
+            stack = [self]
+            while stack:
+                el = stack.pop()
+                children = el.peek_children()
+                yield el
+                stack.extend(reversed(children))
+            return
+        stack = [(None, None, self)]
+        while stack:
+            parent, index, el = stack.pop()
+            if parent is not None:
+                children = parent.peek_children()
+                if index >= len(children) or children[index] is not el:
+                    continue
+                if not parent.own_child_at(index, memo):
+                    continue
+                el = parent.peek_children()[index]
+            children = list(el.peek_children())
+            yield el
+            for i in range(len(children) - 1, -1, -1):
+                stack.append((el, i, children[i]))
+
+    def contains(self, element):
+        """
+        Returns True if element is the present element or one of its
+        descendants.
+        """
+        visited = set()
+        stack = [self]
+        while stack:
+            el = stack.pop()
+            if el is element:
+                return True
+            if id(el) not in visited:
+                visited.add(id(el))
+                stack.extend(el.peek_children())
+        return False
+
+    @staticmethod
+    def own(element, memo=None):
+        """
+        Helper for a parent element that is about to modify one of its
+        children, or to hand it to the client.  If the child element
+        is shared with other parents, it is replaced with a shallow
+        copy, whose own children become shared in turn.  (A shared
+        element can't have been handed to the client, so the client
+        never loses track of it; see expose.)  Copies are therefore
+        only made along the paths that get modified, and everything
+        else stays shared.  Returns the element to be modified and
+        whether it needs modifying.
+
+        When the same modification is being made throughout a tree,
+        the memo dict records the copies made so far, keyed by the id
+        of the shared originals.  A parent that meets a shared child
+        which has already been copied and modified just takes the
+        copy, and False is returned.  That way the child remains
+        shared between the parents that were sharing it before.
+        """
+        if not element.shared:
+            return element, True
+        if memo is not None and id(element) in memo:
+            result = memo[id(element)][1]
+            result.shared = True
+            return result, False
+        result = element.shallow_copy()
+        if memo is not None:
+            # keep the original alive so that its id is not reused
+            memo[id(element)] = (element, result)
+        return result, True
         
     def apply_hooks(self, options_dicts):
         """
@@ -55,18 +691,954 @@ class OptionsTreeElement:
         for func in self.list_hooks:
             func(options_dicts)
         for od in options_dicts:
-            for func in self.dict_hooks:
-                func(od)
-            # could import the Sequence functor here, but writing a
-            # closure is trivial and incurs no coupling
-            def run_item_hooks(target_dict, key):
-                for func in self.item_hooks:
-                    func(target_dict, key)
-            od.transform_items(run_item_hooks, recursive=True)
+            self.apply_dict_hooks(od)
+
+    def apply_dict_hooks(self, options_dict):
+        """
+        Applies the functions in self.dict_hooks and self.item_hooks
+        to a single options dictionary.
+        """
+        for func in self.dict_hooks:
+            func(options_dict)
+        if not self.item_hooks:
+            # save visiting every item for nothing
+            return
+        # could import the Sequence functor here, but writing a
+        # closure is trivial and incurs no coupling
+        def run_item_hooks(target_dict, key):
+            for func in self.item_hooks:
+                func(target_dict, key)
+        options_dict.transform_items(run_item_hooks, recursive=True)
+
+    def collapse(self, layered=False, shard=None, num_shards=None,
+                 partition='blocked', where=None, incremental=False,
+                 memoise=False):
+        """
+        Returns a list of options dictionaries corresponding to the leaves
+        in the the present tree structure.  Each dictionary is the
+        result of a merge from the root, through the branch nodes, to
+        the corresponding leaf.  If layered is True, the dictionaries
+        are LayeredOptionsDicts which share the immutable values of
+        the tree's nodes and only copy the others.
+
+        If memoise is True and neither a shard nor a where function
+        is given, the merged dictionaries are kept on the present
+        element, so collapsing it again in the same way only
+        costs a copy of each one until a node in the tree changes
+        (see refresh_versions).  Changes that the tree can't see, such
+        as a mutable value modified after being put in the tree, or a
+        hook that gives different results from one call to the next,
+        are then missed, so this is best left to trees that aren't
+        modified between collapses.
+
+        The leaves can be split between several processes or hosts by
+        giving a shard number and the total number of shards.  The
+        partition argument may be 'blocked', in which case each shard
+        is a contiguous run of leaves, or 'strided', in which case
+        shard k gets leaves k, k + num_shards, k + 2*num_shards, etc.
+        Subtrees without any leaves in the shard are skipped.  List
+        hooks can add or remove leaves, though, so if the tree has
+        any, the shards are taken from the complete list of hooked
+        leaves instead.
+
+        If a where function is given, only the dictionaries for which
+        it returns True are kept.  The function is also tried at each
+        branch node on the items merged so far, and the subtree is
+        skipped without being merged if the function returns False
+        and nothing beneath the node (including hooks) could change
+        the items that it looked up.  Where it raises an exception,
+        e.g. because an item hasn't been defined yet, the decision is
+        deferred to the nodes below.  The function should only depend
+        on the items, not on the node information.
+
+        If incremental is True, the leaves are cached on each element
+        of the tree, and a later incremental collapse only regenerates
+        the leaves beneath elements that have changed in the meantime;
+        see cache_leaves.  The dictionaries are then LayeredOptionsDicts
+        as above.  This suits trees that are collapsed repeatedly while
+        being edited, but the cache takes up memory in proportion to
+        the number of leaves times the depth of the tree.
+        """
+        if incremental:
+            result = [LayeredOptionsDict(od) for od in self.cache_leaves()]
+            if shard is not None:
+                result = result[slice(*self.get_shard_range(
+                    shard, num_shards, partition, len(result)))]
+            if where is not None:
+                result = [od for od in result if where(od)]
+            return result
+        if memoise and shard is None and where is None:
+            self.refresh_versions()
+            memo = self.collapse_memo
+            if memo is None or memo[0] is not self.subtree_version:
+                # the layered and plain leaves, as they are needed
+                memo = (self.subtree_version, {})
+                self.collapse_memo = memo
+            leaves = memo[1].get(layered)
+            if leaves is None:
+                leaves = list(self.iter_leaves(layered=layered))
+                memo[1][layered] = leaves
+            if layered:
+                return [LayeredOptionsDict(od) for od in leaves]
+            return [deepcopy(od) for od in leaves]
+        return list(self.iter_collapse(
+            layered=layered, shard=shard, num_shards=num_shards,
+            partition=partition, where=where))
+
+    def iter_collapse(self, layered=False, shard=None, num_shards=None,
+                      partition='blocked', where=None):
+        """
+        Generator version of collapse.  The merged options dictionaries
+        are yielded one at a time and in the same order, so only the
+        current branch of the tree is held in memory.  The exception is
+        an element with list hooks, which need the complete list of
+        dictionaries beneath that element before they can be applied.
+        """
+        if shard is None:
+            return self.iter_leaves(layered=layered, where=where)
+        # checks the arguments, even if the range isn't used
+        leaf_range = self.get_shard_range(shard, num_shards, partition)
+        if self.has_list_hooks_below():
+            return self.iter_hooked_shard(shard, num_shards, partition,
+                                          layered, where)
+        return self.iter_leaves(leaf_range, layered=layered, where=where)
+
+    def iter_hooked_shard(self, shard, num_shards, partition, layered,
+                          where):
+        """
+        Yields the options dictionaries in the given shard of the
+        present tree's leaves, for a tree with list hooks.  As the
+        hooks can add or remove leaves, the leaves are all generated
+        before the shard is picked out of them.  Used by
+        iter_collapse.
+        """
+        leaves = list(self.iter_leaves(layered=layered))
+        for od in leaves[slice(*self.get_shard_range(
+                shard, num_shards, partition, len(leaves)))]:
+            if where is None or where(od):
+                yield od
+
+    def iter_leaves(self, leaf_range=None, layered=False, where=None):
+        """
+        Yields hooked options dictionaries for the leaves beneath the
+        present element.  If leaf_range is given as a (start, stop,
+        step) tuple, only the corresponding leaves are yielded.  See
+        collapse for the where argument.
+
+        The tree is walked with an explicit stack.  Each leaf's
+        dictionary is merged upwards through the elements on the
+        current path, which apply their dict hooks in turn, until it
+        reaches the present element or is held back by an element
+        with list hooks.  The held-back dictionaries are released
+        once the rest of that element's subtree has been walked.
+        """
+        # Each frame on the path holds an element, its leaf range, a
+        # list of held-back dictionaries if it has list hooks, and
+        # the items merged down to it if where is being tried on the
+        # way down.
+        path = []
+        if where is None:
+            subtree_keys = None
+            partial = None
+        else:
+            subtree_keys = self.map_subtree_keys()
+            partial = PartialOptionsDict()
+
+        def merge_upwards(od, depth):
+            for el, _, held, _ in reversed(path[:depth + 1]):
+                od = el.merge_options_dict(od, layered)
+                if held is not None:
+                    held.append(od)
+                    return None
+                el.apply_dict_hooks(od)
+            if where is None or where(od):
+                return od
+            return None
+
+        def excludes_subtree(el, partial):
+            try:
+                if where(partial):
+                    return False
+            except Exception:
+                # defer to the nodes below
+                return False
+            keys_below = set()
+            for child in el.peek_children():
+                keys, hooked = subtree_keys[id(child)]
+                if hooked:
+                    return False
+                keys_below.update(keys)
+            if partial._all_keys_accessed:
+                return not keys_below
+            return not partial._accessed_keys.intersection(keys_below)
+
+        # The stack holds an iterator over the (child, leaf range)
+        # pairs of each element on the path, below one for the present
+        # element itself, so that the children are only created (e.g.
+        # by a VirtualOptionsArray) as they are reached.  An exhausted
+        # iterator marks the point where an element's subtree has been
+        # walked.
+        stack = [iter([(self, leaf_range)])]
+        while stack:
+            pair = next(stack[-1], None)
+            if pair is None:
+                stack.pop()
+                if not path:
+                    continue
+                el, rng, held, _ = path.pop()
+                if held is None:
+                    continue
+                for func in el.list_hooks:
+                    func(held)
+                if rng is not None:
+                    held = held[slice(*rng)]
+                for od in held:
+                    el.apply_dict_hooks(od)
+                    od = merge_upwards(od, len(path) - 1)
+                    if od is not None:
+                        yield od
+                continue
+
+            el, rng = pair
+            if path:
+                partial = path[-1][3]
+            if partial is not None:
+                if el.has_hooks():
+                    # the hooks could change any item
+                    partial = None
+                elif el.get_options_dict() is not None and \
+                     not el.is_leaf():
+                    partial = PartialOptionsDict(partial)
+                    partial.merge(el.get_options_dict())
+                    if excludes_subtree(el, partial):
+                        continue
+            
+            if el.list_hooks:
+                # the list hooks need every dictionary beneath this
+                # element, so it is sliced afterwards instead
+                path.append((el, rng, [], partial))
+                rng = None
+            else:
+                path.append((el, rng, None, partial))
+            stack.append(iter(el.split_leaf_range(rng)))
+            if el.is_leaf() and (rng is None or rng[0] == 0 < rng[1]):
+                od = merge_upwards(None, len(path) - 1)
+                if od is not None:
+                    yield od
+
+    def refresh_versions(self):
+        """
+        Brings the subtree versions of the present element and its
+        descendants up to date, and returns the elements in post-order
+        (each shared element appearing once).
+
+        An element's subtree version is replaced whenever its own
+        version (see touch), its hooks or the subtree versions of its
+        children differ from last time.  It therefore identifies the
+        state of the whole subtree, and results that are cached
+        against it remain valid for as long as it stays the same.
+        Shallow copies start out with the same subtree version.
+        """
+        result = []
+        visited = set()
+        stack = [self]
+        while stack:
+            el = stack[-1]
+            if id(el) in visited:
+                stack.pop()
+                continue
+            children = el.peek_children()
+            pending = [child for child in children
+                       if id(child) not in visited]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            visited.add(id(el))
+            el.touch_if_changed()
+            key = (el.version,
+                   tuple(child.subtree_version for child in children),
+                   tuple(el.list_hooks), tuple(el.dict_hooks),
+                   tuple(el.item_hooks))
+            if el.subtree_key != key:
+                el.subtree_key = key
+                el.subtree_version = object()
+            result.append(el)
+        return result
+
+    def refresh_hashes(self):
+        """
+        Brings the structural hashes cached on the present element and
+        its descendants up to date, and returns the present element's
+        hash.  Each hash is cached against the element's subtree
+        version (see refresh_versions), so only the elements whose
+        subtrees have changed are hashed again, and copies start out
+        with the same hashes.
+        """
+        for el in self.refresh_versions():
+            if el.hash_cache is None or \
+               el.hash_cache[0] is not el.subtree_version:
+                child_hashes = [child.hash_cache[1]
+                                for child in el.peek_children()]
+                el.hash_cache = (el.subtree_version,
+                                 el.compute_hash(child_hashes))
+        return self.hash_cache[1]
+
+    def compute_hash(self, child_hashes):
+        """
+        Returns the structural hash of the present element from its
+        name, its items (see hash_items) and the hashes of its
+        children.  Used by refresh_hashes.
+        """
+        od = self.get_options_dict()
+        items_hash = None if od is None else hash_items(od)
+        return hash((str(self), items_hash, tuple(child_hashes)))
+
+    def to_spec(self):
+        """
+        Returns a compact description of the tree, made up of dicts,
+        lists, strings and numbers so that it can be written out with
+        the json module (or pickled).  from_spec() turns it back into
+        an equal tree.  The description is usually much smaller than a
+        pickle of the tree, but loading it takes about as long as
+        unpickling, or longer if there are many nodes to rebuild.
+
+        Each distinct element is described once, after its
+        descendants, so shared subtrees stay shared.  An array whose
+        nodes hold values under the array name and share a child is
+        described by its values; see OptionsArray.get_spec.  Node
+        information is rebuilt from the structure rather than stored.
+        Item values and hooks are encoded by encode_value, so
+        dependent items need to be module-level functions.
+        """
+        elements = self.refresh_versions()
+        # Find the elements that the descriptions refer to, going from
+        # the root down; reversing the post-order puts parents first.
+        needed = set([id(self)])
+        for el in reversed(elements):
+            if id(el) in needed:
+                needed.update(id(child) for child in el.get_spec_children())
+        indices = {}
+        specs = []
+        for el in elements:
+            if id(el) not in needed:
+                continue
+            spec = el.get_spec(indices)
+            for name in ['list_hooks', 'dict_hooks', 'item_hooks']:
+                hooks = getattr(el, name)
+                if hooks:
+                    spec[name] = [encode_value(h) for h in hooks]
+            indices[id(el)] = len(specs)
+            specs.append(spec)
+        return {'opiter_spec': SPEC_VERSION, 'elements': specs}
+
+    def get_spec_children(self):
+        """
+        Returns the elements that the present element's description
+        refers to.  Used by to_spec.
+        """
+        return self.peek_children()
+
+    def snapshot(self, path, item_hooks=[]):
+        """
+        Collapses the tree and writes the options dictionaries to a
+        file at path, from which they can be read back one at a time
+        by index or name with LeafSnapshot.  This saves collapsing a
+        large tree again in every script or process that needs the
+        leaves.
+
+        The dictionaries are pickled, so any dependent items must be
+        module-level functions.  Otherwise they can be converted into
+        independent items by passing item_hooks=[unlink].  They are
+        written as they are generated (see iter_collapse), so the
+        leaves are never all held in memory at once.
+        """
+        write_snapshot(self.iter_snapshot_leaves(item_hooks), path)
+
+    def iter_snapshot_leaves(self, item_hooks):
+        """
+        Generates the options dictionaries for snapshot, with the item
+        hooks applied.  The leaves aren't kept for another collapse, so
+        the item hooks are free to change them in place.
+        """
+        for od in self.iter_collapse(layered=True):
+            if item_hooks:
+                od.transform_items(Sequence(item_hooks))
+            yield od
+
+    def cache_leaves(self):
+        """
+        Brings the leaves cached on the present element and its
+        descendants up to date, and returns the hooked options
+        dictionaries for the present element's leaves.  These belong
+        to the cache and must not be modified.  Used by
+        collapse(incremental=True).
+
+        Each element caches the leaves beneath it against its subtree
+        version (see refresh_versions).  When that changes, the
+        element rebuilds its leaves from its children's caches, which
+        only involves merging its own dictionary, if any, into each
+        one.  Shallow copies of an element share its cache, so the
+        parts of a tree that are shared with an earlier version get
+        reused too.
+        """
+        for el in self.refresh_versions():
+            if el.leaf_cache is None or \
+               el.leaf_cache[0] is not el.subtree_version:
+                el.leaf_cache = (el.subtree_version, el.build_leaf_cache())
+        return self.leaf_cache[1]
+
+    def build_leaf_cache(self):
+        """
+        Returns the hooked options dictionaries for the leaves beneath
+        the present element, built from the caches of its children.
+        Used by cache_leaves.
+        """
+        result = self.merge_cached_leaves()
+        if self.has_hooks():
+            # the hooks mustn't modify the dictionaries held by the
+            # children's caches
+            result = [LayeredOptionsDict(od) for od in result]
+            self.apply_hooks(result)
+        return result
+
+    def merge_cached_leaves(self):
+        """
+        Returns LayeredOptionsDicts for the leaves beneath the present
+        element, merged with the dictionaries cached on its children.
+        Used by build_leaf_cache.
+        """
+        if self.is_leaf():
+            return [self.merge_options_dict(None, layered=True)]
+        return [self.merge_options_dict(od, layered=True)
+                for child in self.peek_children()
+                for od in child.leaf_cache[1]]
+
+    def constrain(self, constraints):
+        """
+        Returns a copy of the present tree without the branches that
+        are excluded by constraints.  Each constraint is a function
+        that takes an options dictionary and returns True if it is to
+        be excluded; see Exclude.  The constraints only see the items
+        and not the node information, and hooks are not applied.
+
+        At each node, the constraints are tried on the items merged
+        from the root so far.  The node and its subtree are removed
+        as soon as a constraint returns True, provided that none of
+        the items it looked up are redefined further down.  If a
+        constraint raises a KeyError or similar because an item has
+        yet to be defined, it is tried again further down, and a leaf
+        for which it still can't be evaluated is kept.  An array or
+        branch node with nothing left beneath it is removed too.
+
+        Only the elements on the paths to removed branches are
+        copied; everything else is shared with the present tree,
+        including subtrees that fare the same under different
+        parents.  The result is None if every leaf is excluded.
+        """
+        subtree_keys = self.map_subtree_keys()
+        result, _ = self.prune(PartialOptionsDict(), tuple(constraints),
+                               subtree_keys, {})
+        if result is self:
+            # nothing was removed, but the client holds the tree
+            result = self.expose().shallow_copy()
+        return result
+
+    def select(self, **items):
+        """
+        Returns a narrowed copy of the present tree, keeping only the
+        branches whose items match the given ones, e.g.
+
+           tree.select(velocity=[0.01, 0.04], fluid='water')
+
+        A list, tuple or set gives the values to choose from.  Branches
+        that don't define an item at all are kept.  As with constrain,
+        which does the work, the copy shares everything but the paths
+        to the removed branches with the present tree, and the node
+        information is brought up to date along those paths.  The
+        result is None if nothing matches.
+        """
+        def exclude_unless(key, values):
+            if not isinstance(values, (list, tuple, set, frozenset)):
+                values = [values]
+            return lambda od: od[key] not in values
+        return self.constrain([exclude_unless(key, values)
+                               for key, values in sorted(items.items())])
+
+    def prune(self, partial, constraints, subtree_keys, memo):
+        """
+        Helper for constrain.  Applies constraints to the present
+        subtree, given the items merged down to its parent, and
+        returns the result and the keys that the constraints looked
+        up (or None if they looked at all of them).  The memo holds
+        the results for each element and set of constraints, keyed by
+        the values of the keys that were looked up, so that an element
+        can be shared wherever those values are the same.
+
+        The subtree is walked with an explicit stack, each frame of
+        which holds an element whose children are being pruned.
+        """
+        stack = []
+        # the next element to prune, or else the result and used keys
+        # of the one just finished
+        pending = (self, partial, constraints)
+        returned = None
+        while True:
+            if pending is not None:
+                el, parent_partial, constraints = pending
+                pending = None
+                target = el.prune_target(memo)
+                memo_entries = memo.setdefault((id(target), constraints), [])
+                for used, values, result in memo_entries:
+                    if get_used_values(parent_partial, used) == values:
+                        # the result is shared by replace_children
+                        returned = (el if result is target else result,
+                                    used)
+                        break
+                else:
+                    partial, constraints, used, result = \
+                        target.prune_locally(parent_partial, constraints,
+                                             subtree_keys)
+                    stack.append([el, target, parent_partial, partial,
+                                  constraints, used, result, memo_entries,
+                                  target.peek_children(), 0, []])
+            else:
+                frame = stack[-1]
+                (el, target, parent_partial, partial, constraints, used,
+                 result, memo_entries, children, i, new_children) = frame
+                if returned is not None:
+                    new_child, child_used = returned
+                    returned = None
+                    if child_used is None:
+                        used = frame[5] = None
+                    elif used is not None:
+                        used.update(child_used)
+                    if new_child is not None:
+                        new_children.append(new_child)
+                if result is not None and constraints and i < len(children):
+                    frame[9] = i + 1
+                    pending = (children[i], partial, constraints)
+                    continue
+                if result is not None and constraints:
+                    if not new_children:
+                        result = None
+                    elif len(new_children) < len(children) or any(
+                            new is not old
+                            for new, old in zip(new_children, children)):
+                        result = target.replace_children(new_children)
+                memo_entries.append(
+                    (used, get_used_values(parent_partial, used), result))
+                stack.pop()
+                returned = (el if result is target else result, used)
+            if returned is not None and not stack:
+                return returned
+
+    def prune_target(self, memo):
+        """
+        Returns the element that prune works on in place of the present
+        one, which is the present element itself unless overridden.
+        """
+        return self
+
+    def prune_locally(self, partial, constraints, subtree_keys):
+        """
+        Helper for prune.  Tries the constraints on the items merged
+        down to the present element, and returns the items merged into
+        the present element, the constraints that are left to try on
+        its children, the keys looked up (or None) and the present
+        element, or None if it is excluded.
+        """
+        used = set()
+        result = self
+        od = self.get_options_dict()
+        if od is None:
+            return partial, constraints, used, result
+        partial = PartialOptionsDict(partial)
+        partial.merge(od)
+        keys_below = set()
+        for child in self.peek_children():
+            keys_below.update(subtree_keys[id(child)][0])
+        remaining = []
+        for func in constraints:
+            partial._accessed_keys = set()
+            partial._all_keys_accessed = False
+            try:
+                excluded = func(partial)
+                decided = True
+            except MissingDependencyExceptions as e:
+                # a leaf with an undefined item is kept.  The missing
+                # key decides the outcome as much as any other, so it
+                # is recorded even if it wasn't looked up through
+                # partial; if it can't be told, all keys count.
+                excluded = False
+                decided = self.is_leaf()
+                if isinstance(e, KeyError) and len(e.args) == 1:
+                    partial._accessed_keys.add(e.args[0])
+                else:
+                    partial._all_keys_accessed = True
+            if partial._all_keys_accessed:
+                used = None
+                decided = decided and not keys_below
+            else:
+                if used is not None:
+                    used.update(partial._accessed_keys)
+                decided = decided and not \
+                          keys_below.intersection(partial._accessed_keys)
+            if decided and excluded:
+                result = None
+                break
+            if not decided:
+                remaining.append(func)
+        return partial, tuple(remaining), used, result
+
+    def map_subtree_keys(self):
+        """
+        Returns a dict mapping the id of each element in the present
+        tree to a set of the item keys defined in the element's
+        subtree and whether the subtree has any hooks.  Used by
+        iter_leaves.
+        """
+        result = {}
+        stack = [self]
+        while stack:
+            el = stack[-1]
+            if id(el) in result:
+                stack.pop()
+                continue
+            children = el.peek_children()
+            pending = [child for child in children
+                       if id(child) not in result]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            keys = set(el.get_local_keys())
+            hooked = el.has_hooks()
+            for child in children:
+                child_keys, child_hooked = result[id(child)]
+                keys.update(child_keys)
+                hooked = hooked or child_hooked
+            result[id(el)] = (keys, hooked)
+        return result
+
+    def get_shard_range(self, shard, num_shards, partition='blocked',
+                        n_leaves=None):
+        """
+        Returns the leaves belonging to the given shard as a (start,
+        stop, step) tuple.  See collapse.  The number of leaves to
+        share out defaults to the present element's leaf count.
+        """
+        if not num_shards or num_shards < 1:
+            raise OptionsTreeElementException(
+                "num_shards must be a positive integer")
+        if shard < 0 or shard >= num_shards:
+            raise OptionsTreeElementException(
+                "shard must be in the range 0 to num_shards - 1")
+        if n_leaves is None:
+            n_leaves = self.count_leaves()
+        if partition == 'blocked':
+            return (shard * n_leaves // num_shards,
+                    (shard + 1) * n_leaves // num_shards, 1)
+        elif partition == 'strided':
+            return (shard, n_leaves, num_shards)
+        else:
+            raise OptionsTreeElementException(
+                "partition must be 'blocked' or 'strided'; is {}".\
+                format(partition))
+
+    def leaf(self, index, layered=False):
+        """
+        Returns the options dictionary that would be found at the given
+        index in the result of collapse, without collapsing the rest
+        of the tree.  Only the nodes on the path to the leaf are
+        visited, with per-subtree leaf counts being used to choose the
+        path.  As with list indexing, a negative index counts back from
+        the last leaf.
+
+        List hooks may reorder or remove dictionaries, so the leaf
+        counts can't be relied on for a subtree that has any.  The
+        leaves beneath the first element on the path whose subtree has
+        list hooks are therefore collapsed in full instead.
+        """
+        if not self.has_list_hooks_below():
+            n_leaves = self.count_leaves()
+            if index < 0:
+                index += n_leaves
+            if index < 0 or index >= n_leaves:
+                raise IndexError("leaf index out of range")
+        path = []
+        el = self
+        od = None
+        while True:
+            if el.has_list_hooks_below():
+                od = el.collapse(layered=layered)[index]
+                break
+            path.append(el)
+            if el.is_leaf():
+                break
+            el, index = el.child_with_leaf(index)
+        return merge_path(path, od, layered)
+
+    def multiply_attach(self, tree):
+        """
+        Appends a copy of tree to each leaf node in the present tree
+        structure.  Rather than each leaf getting its own copy, one
+        copy is shared between all the leaves, so the tree becomes a
+        directed acyclic graph.  Shared elements are copied as and when
+        they need to be modified; see own().
+        """
+        if tree.contains(self):
+            # the present element is about to be modified in place, so
+            # sharing it with the tree would create a cycle
+            tree = deepcopy(tree)
+        else:
+            # the client holds the tree
+            tree = tree.expose().shallow_copy()
+        tree.update_node_info()
+        tree.shared = self.count_leaves() > 1
+        self.attach_to_leaves(tree, {})
+
+    def attach_to_leaves(self, tree, memo):
+        """
+        Makes tree the child of each leaf node in the present tree
+        structure.  Used by multiply_attach; see own() for the memo
+        argument.
+        """
+        for el in self.walk(modify=True, memo=memo):
+            el.multiply_attach_locally(tree)
+            # the walk only visits the leaves and their ancestors
+            el.leaf_count = None
+        self.shape_changed()
+
+    def attach(self, tree):
+        """
+        Appends a copy of each root node in the tree argument (or
+        whichever elements get traversed during iteration) to a
+        corresponding leaf node in the present tree.  Returns whatever
+        is left of the source tree (for an array, a slice of it
+        holding the nodes that weren't attached).
+        """
+        for el in self.walk(modify=True):
+            if not tree:
+                # no more elements to attach, so exit early
+                break
+            tree = el.attach_locally(tree)
+            el.leaf_count = None
+        self.shape_changed()
+        if hasattr(tree, 'get_remainder'):
+            # an array hands out its nodes through a NodeDonor
+            tree = tree.get_remainder()
+        return tree
+
+    def count_leaves(self):
+        """
+        Returns the number of leaves beneath the present element.  The
+        count is cached; see cache_shape.
+        """
+        self.cache_shape()
+        return self.leaf_count
+
+    def has_list_hooks_below(self):
+        """
+        Returns True if the present element or any of its descendants
+        has list hooks.  The flag is cached along with the leaf count;
+        see cache_shape.
+        """
+        self.cache_shape()
+        return self.list_hooks_below
+
+    @property
+    def shape(self):
+        """
+        If the present tree is a regular product of arrays, a tuple of
+        the array lengths met on the way from the present element to
+        any leaf (nodes don't count); otherwise None.  The shape is
+        cached; see cache_shape.
+        """
+        self.cache_shape()
+        return self.subtree_shape
+
+    def cache_shape(self):
+        """
+        Brings the leaf counts and shapes cached on the present
+        element and its descendants up to date, along with whether
+        their subtrees have any list hooks.  A cache is discarded (by
+        setting leaf_count to None) when the element's subtree changes
+        shape or its list hooks are assigned, along with those of its
+        ancestors (see shape_changed), so only the discarded ones are
+        recomputed.
+        Each element of a shared subtree is then only visited once,
+        and the other trees that share it keep their caches.
+        """
+        stack = [self]
+        while stack:
+            el = stack[-1]
+            if el.leaf_count is not None:
+                stack.pop()
+                continue
+            stale = [child for child in el.peek_children()
+                     if child.leaf_count is None]
+            if stale:
+                stack.extend(stale)
+                continue
+            stack.pop()
+            el.leaf_count, el.subtree_shape = el.count_and_shape()
+            el.list_hooks_below = bool(el.list_hooks) or \
+                any(child.list_hooks_below for child in el.peek_children())
+
+    def shape_changed(self):
+        """
+        Discards the leaf counts and shapes cached on the present
+        element and its ancestors.  Called by any method that adds or
+        removes elements, and should also be called after adding or
+        removing nodes in the list returned by OptionsArray.nodes.
+
+        Elements don't keep track of their parents in general, but
+        the only ones that can change shape on their own are those
+        that have been exposed to the client, which remember the
+        parents that exposed them (see expose); anything else is
+        modified by walking down from the root.  An ancestor whose
+        cache has already been discarded needn't be visited again,
+        since neither have its own ancestors' caches been rebuilt.
+        """
+        stack = [self]
+        while stack:
+            el = stack.pop()
+            if el.leaf_count is None and el is not self:
+                continue
+            el.leaf_count = None
+            if el.parents:
+                for parent_ref in el.parents.values():
+                    parent = parent_ref()
+                    if parent is not None:
+                        stack.append(parent)
+
+    def update(self, items):
+        """
+        Updates the leaf dictionaries with items.  Shared subtrees are
+        copied once and stay shared; see own().
+        """
+        for el in self.walk(modify=True, memo={}):
+            el.update_locally(items)
+
+    def find_leaf_by_name(self, name, node_separator):
+        """
+        Returns the index of the leaf whose string identifier is name,
+        ignoring any list hooks, and the elements on the path to it,
+        or None if there is no such leaf.  Used by locate.
+
+        The candidates offered by each element's match_name are tried
+        in turn, depth first, with an explicit stack, since a node
+        name can be repeated or end in the separator.
+        """
+        # each frame holds an element, the rest of the name, the index
+        # of the element's first leaf and the path to the element's
+        # parent, as a linked list of (element, path) pairs
+        stack = [(self, name, 0, None)]
+        while stack:
+            el, name, offset, path = stack.pop()
+            if el is None:
+                return offset, unlink_path(path)
+            path = (el, path)
+            stack.extend((child, remainder, offset + child_offset, path)
+                         for child, remainder, child_offset in
+                         reversed(el.match_name(name, node_separator)))
+        return None
+
+    def find_leaf_by_items(self, items):
+        """
+        Returns the index of the leaf matching items of the form
+        {array_name: value}, ignoring any list hooks, and the elements
+        on the path to it, or None if there is no such leaf.  Used by
+        locate.  The candidates offered by each element's match_items
+        are tried in turn, as in find_leaf_by_name.
+        """
+        stack = [(self, 0, None)]
+        while stack:
+            el, offset, path = stack.pop()
+            if el is None:
+                return offset, unlink_path(path)
+            path = (el, path)
+            stack.extend((child, offset + child_offset, path)
+                         for child, child_offset in
+                         reversed(el.match_items(items)))
+        return None
+
+    def locate(self, key, node_separator='_', layered=False):
+        """
+        Finds a leaf from either its string identifier, as returned by
+        OptionsDict.get_string() with the default formatter, or a dict
+        of items of the form {array_name: value}.  Returns the index
+        of the leaf (see leaf()) and the merged options dictionary.
+
+        The search is guided by hash indices of node names and values
+        held by each array, so the tree is not collapsed.  When
+        locating from items, any array in the path must be given
+        unless it has only one node.
+
+        List hooks may reorder or remove dictionaries, so if the tree
+        has any, the leaf that was found is looked for in the result
+        of collapse by its string identifier instead.
+        """
+        if isinstance(key, basestring):
+            found = self.find_leaf_by_name(key, node_separator)
+        else:
+            found = self.find_leaf_by_items(key)
+        if found is not None:
+            index, path = found
+            od = merge_path(path, None, layered)
+            if not self.has_list_hooks_below():
+                return index, od
+            name = od.get_string()
+            for index, od in enumerate(self.collapse(layered=layered)):
+                if od.get_string() == name:
+                    return index, od
+        raise OptionsTreeElementException(
+            "couldn't locate a leaf matching {}".format(repr(key)))
+
+    def __eq__(self, other):
+        """
+        Returns True if other holds the same names, items and node
+        information in the same arrangement.  Subtrees that are shared
+        by both trees, and pairs of subtrees that have already been
+        compared, are not compared again, and the comparison stops at
+        the first difference.  The versions and cached hashes aren't
+        relied on, since an options dictionary can be modified without
+        the element knowing.
+        """
+        if self is other:
+            return True
+        if not isinstance(other, OptionsTreeElement):
+            return False
+        # the memo also keeps the elements alive, so that their ids are
+        # not reused by any that are created on demand
+        memo = {}
+        stack = [(self, other)]
+        while stack:
+            a, b = stack.pop()
+            if a is b:
+                continue
+            key = (id(a), id(b))
+            if key in memo:
+                continue
+            memo[key] = (a, b)
+            pairs = a.compare_locally(b)
+            if pairs is None:
+                return False
+            stack.extend(reversed(pairs))
+        return True
 
     def __ne__(self, other):
         return not self == other
 
+    def __hash__(self):
+        """
+        Returns the structural hash of the tree; see refresh_hashes.
+        Like any dict key, a tree that is used as one mustn't be
+        modified.
+        """
+        return self.refresh_hashes()
+
     @nonmutable
     def __mul__(self, other):
         self.multiply_attach(other)
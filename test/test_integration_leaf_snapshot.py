@@ -0,0 +1,117 @@
+import unittest
+from opiter.leaf_snapshot import LeafSnapshot, LeafSnapshotException, \
+    write_snapshot
+from opiter.options_array import OptionsArray
+from opiter.options_node import OptionsNode
+from opiter.options_dict import unlink
+from multiprocessing import Pool
+from tempfile import mkdtemp
+from shutil import rmtree
+import os
+
+
+def product(opt):
+    return (1 + 'ABC'.index(opt['letter'])) * opt['number']
+
+def lookup_product(args):
+    snapshot, index = args
+    return snapshot[index]['product']
+
+
+class TestLeafSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        """
+        I snapshot a tree with a root node, two letters and two
+        numbers.
+        """
+        letters = OptionsArray('letter', ['A', 'B'])
+        numbers = OptionsArray('number', range(2))
+        self.tree = OptionsNode('root') * letters * numbers
+        self.tree.update({'limits': [0, 1], 'product': product})
+        self.dir = mkdtemp()
+        self.path = os.path.join(self.dir, 'tree.snapshot')
+        self.tree.snapshot(self.path)
+        self.snapshot = LeafSnapshot(self.path)
+
+    def tearDown(self):
+        self.snapshot.close()
+        rmtree(self.dir)
+
+    def test_leaves(self):
+        self.assertEqual(len(self.snapshot), 4)
+        self.assertEqual(list(self.snapshot), self.tree.collapse())
+        self.assertEqual([str(od) for od in self.snapshot],
+                         ['root_A_0', 'root_A_1', 'root_B_0', 'root_B_1'])
+        self.assertEqual([od['product'] for od in self.snapshot],
+                         [0, 1, 0, 2])
+
+    def test_indexing(self):
+        self.assertEqual(str(self.snapshot[-1]), 'root_B_1')
+        self.assertEqual(self.snapshot[1:3], self.tree.collapse()[1:3])
+        self.assertRaises(IndexError, lambda: self.snapshot[4])
+
+    def test_name_lookup(self):
+        self.assertEqual(self.snapshot.index('root_B_0'), 2)
+        self.assertEqual(self.snapshot['root_A_1'],
+                         self.tree.collapse()[1])
+        self.assertRaises(KeyError, lambda: self.snapshot['root_C_0'])
+
+    def test_leaves_are_independent(self):
+        od = self.snapshot[0]
+        od['limits'].append(2)
+        self.assertEqual(self.snapshot[0]['limits'], [0, 1])
+        self.assertEqual(self.snapshot[1]['limits'], [0, 1])
+
+    def test_across_processes(self):
+        # each process maps the file again and loads its own leaf
+        pool = Pool(2)
+        results = pool.map(lookup_product,
+                           [(self.snapshot, i) for i in range(4)])
+        pool.close()
+        self.assertEqual(results, [0, 1, 0, 2])
+
+    def test_lambda(self):
+        self.tree.update({'twice': lambda opt: 2 * opt['number']})
+        self.assertRaises(LeafSnapshotException, self.tree.snapshot,
+                          self.path)
+        self.assertEqual(os.listdir(self.dir), ['tree.snapshot'])
+        self.tree.snapshot(self.path, item_hooks=[unlink])
+        with LeafSnapshot(self.path) as snapshot:
+            self.assertEqual([od['twice'] for od in snapshot], [0, 2, 0, 2])
+        # the file was replaced rather than overwritten
+        self.assertNotIn('twice', self.snapshot[0])
+
+    def test_relative_path(self):
+        cwd = os.getcwd()
+        os.chdir(self.dir)
+        try:
+            self.tree.snapshot('relative.snapshot')
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['relative.snapshot', 'tree.snapshot'])
+
+    def test_file_mode(self):
+        umask = os.umask(027)
+        try:
+            self.tree.snapshot(self.path)
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0640)
+        self.assertEqual(os.listdir(self.dir), ['tree.snapshot'])
+
+    def test_write_from_generator(self):
+        write_snapshot((od for od in self.tree.collapse()), self.path)
+        with LeafSnapshot(self.path) as snapshot:
+            self.assertEqual(list(snapshot), self.tree.collapse())
+            self.assertEqual(snapshot.index('root_B_0'), 2)
+
+    def test_not_a_snapshot(self):
+        with open(self.path, 'w') as f:
+            f.write('root_A_0')
+        self.assertRaises(LeafSnapshotException, LeafSnapshot, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
 import unittest
+from copy import deepcopy
 from opiter.options_array import OptionsArray, OptionsArrayException, \
-    ArrayNodeInfo, OptionsArrayFactory
+    ArrayNodeInfo, OptionsArrayFactory, VirtualOptionsArray
 from opiter.options_node import OptionsNode, OrphanNodeInfo
+from opiter.options_tree_elements import OptionsTreeElementException
 from opiter.options_dict import OptionsDict
     
 
@@ -170,6 +172,25 @@ class TestOptionsArrayBasics(unittest.TestCase):
             ni = od.get_node_info()
             self.assertTrue(ni.position.is_at(i))
 
+    def test_getitem_from_slice_shares_subtrees(self):
+        self.array[1] *= OptionsArray('colour', ['red', 'blue'])
+        subarray = self.array[1:3]
+        self.assertIs(subarray._nodes[0]._child, self.array._nodes[1]._child)
+        self.assertEqual(subarray.count_leaves(), 3)
+        subarray[0].update({'foo': 'qux'})
+        self.assertNotIn('foo', self.array.collapse()[1])
+
+    def test_getitem_from_slice_shares_values(self):
+        self.array.update({'limits': [0, 1]})
+        subarray = self.array[1:]
+        self.assertIs(subarray._nodes[0]._options_dict['limits'],
+                      self.array._nodes[1]._options_dict['limits'])
+        self.assertTrue(subarray.collapse()[0].get_position().is_at(0))
+        self.assertTrue(self.array.collapse()[1].get_position().is_at(1))
+        # the client may modify the values of a node it has been handed
+        subarray[0].options_dict['limits'].append(2)
+        self.assertEqual(self.array.collapse()[1]['limits'], [0, 1])
+
     def test_setitem_from_index_and_check_type_and_node_info(self):
         node = OptionsNode('some_other_dict', {'foo': 'baz'})
         self.array[2] = 3
@@ -215,7 +236,78 @@ class TestOptionsArrayBasics(unittest.TestCase):
         ni = od.get_node_info()
         self.assertIsInstance(ni, ArrayNodeInfo)
         self.assertTrue(ni.position.is_at(index))
-        self.assertEqual(ni.node_names, expected_node_names)
+        self.assertEqual(ni.node_names, tuple(expected_node_names))
+
+    def test_access_by_name_after_modification(self):
+        self.assertEqual(str(self.array['3.14']), '3.14')
+        del self.array['A']
+        self.array.append(OptionsNode('5'))
+        self.array['some_dict'] = 'B'
+        self.assertEqual(str(self.array['5']), '5')
+        self.assertEqual(str(self.array[1]), 'B')
+        self.assertRaises(TypeError, lambda: self.array['A'])
+
+    def test_extend_and_check_node_info(self):
+        self.array.extend([OptionsNode('5'), OptionsNode('6')])
+        self.check_array_node_info(-1, self.expected_names + ['5', '6'])
+        self.assertRaises(OptionsArrayException,
+                          lambda: self.array.extend(['7']))
+
+    def test_insert_many_and_check_node_info(self):
+        self.array.insert_many('3.14', [OptionsNode('5'), OptionsNode('6')])
+        self.check_array_node_info(
+            2, ['A', '5', '6', '3.14', 'some_dict', 'another_dict'])
+
+    def test_remove_many_and_check_node_info(self):
+        removed = self.array.remove_many(['some_dict', 0, -1])
+        self.assertEqual([str(node) for node in removed],
+                         ['A', 'some_dict', 'another_dict'])
+        self.assertNotIsInstance(removed[0].collapse()[0].get_node_info(),
+                                 ArrayNodeInfo)
+        self.check_array_node_info(0, ['3.14'])
+
+    def test_batch(self):
+        with self.array.batch():
+            with self.array.batch():
+                self.array.append(OptionsNode('5'))
+            del self.array['A']
+            self.assertEqual(str(self.array['5']), '5')
+            self.assertEqual(len(self.array.collapse()), 4)
+            self.array[0] = 'B'
+        self.check_array_node_info(
+            -1, ['B', 'some_dict', 'another_dict', '5'])
+
+    def test_indices_extended_by_append(self):
+        name_index = self.array.get_name_index()
+        value_index = self.array.get_value_index()
+        copied = deepcopy(self.array)
+        copied.get_name_index()
+        with self.array.batch():
+            self.array.append(OptionsNode('5', {self.array.name: 5}))
+            self.array.extend([OptionsNode('A'), OptionsNode('6')])
+            self.assertIs(self.array.get_name_index(), name_index)
+            self.assertEqual(self.array.locate('A')[0], 0)
+            self.assertEqual(self.array.locate('6')[0], 6)
+        self.assertIs(self.array.get_name_index(), name_index)
+        self.assertIs(self.array.get_value_index(), value_index)
+        self.assertEqual(name_index['A'], [0, 5])
+        self.assertEqual(value_index[5], [4])
+        self.assertNotIn('5', copied.get_name_index())
+        del self.array['A']
+        self.assertEqual(self.array.get_name_index()['A'], [4])
+
+    def test_copy_during_batch(self):
+        with self.array.batch():
+            self.array.append(OptionsNode('5'))
+            copied = deepcopy(self.array)
+        self.assertEqual(copied.batch_depth, 0)
+        ni = copied.collapse()[-1].get_node_info()
+        self.assertEqual(ni.node_names, tuple(self.expected_names + ['5']))
+
+    def test_node_names_are_shared(self):
+        node_infos = [od.get_node_info() for od in self.array.collapse()]
+        for ni in node_infos[1:]:
+            self.assertIs(ni.node_names, node_infos[0].node_names)
 
     def test_append_and_check_node_info(self):
         # append with primitive
@@ -261,6 +353,143 @@ class TestOptionsArraySlice(unittest.TestCase):
             self.assertTrue(pos.is_at(i))
 
             
+class TestOptionsArrayLocate(unittest.TestCase):
+
+    def setUp(self):
+        self.array = OptionsArray('x', ['a_b', 'a', 0.5]) * \
+                     OptionsArray('y', ['b_c', 'c'])
+
+    def test_locate_names_containing_separator(self):
+        self.assertEqual(self.array.locate('a_b_c')[0], 2)
+        self.assertEqual(self.array.locate('a_b_b_c')[0], 0)
+
+    def test_locate_from_value_or_name(self):
+        self.assertEqual(self.array.locate({'x': 0.5, 'y': 'c'})[0], 5)
+        self.assertEqual(self.array.locate({'x': '0.5', 'y': 'c'})[0], 5)
+
+    def test_locate_repeated_names(self):
+        array = OptionsArray('d', ['1', '9', '1'])
+        array[0] *= OptionsArray('e', [5, 6])
+        self.assertEqual(array.locate('1')[0], 3)
+        self.assertEqual(array.locate('1_6')[0], 1)
+        self.assertEqual(array.locate({'d': '1', 'e': 6})[0], 1)
+        self.assertEqual(array.locate({'d': '1', 'e': 7})[0], 3)
+        self.assertEqual(array['1'], array[0])
+
+            
+class TestVirtualOptionsArray(unittest.TestCase):
+
+    def setUp(self):
+        self.array = OptionsArray.from_range('x', 1, 10, 2,
+                                             name_format='x{}')
+        self.expected = OptionsArray('x', range(1, 10, 2),
+                                     name_format='x{}')
+
+    def test_from_range(self):
+        self.assertIsInstance(self.array, VirtualOptionsArray)
+        self.assertEqual(len(self.array), 5)
+        self.assertEqual(self.array.collapse(), self.expected.collapse())
+
+    def test_equality_and_hash(self):
+        self.assertEqual(self.array, self.expected)
+        self.assertEqual(self.expected, self.array)
+        self.assertEqual(hash(self.array), hash(self.expected))
+        self.assertNotEqual(self.array, self.expected[:-1])
+
+    def test_node_names(self):
+        names = [od._node_info[-1].node_names
+                 for od in self.array.collapse()]
+        self.assertIs(names[0], names[-1])
+        self.assertEqual(names[0], self.expected.get_node_names())
+        self.assertEqual(names[0], self.array[:].get_node_names())
+        self.assertNotEqual(names[0], self.array[1:].get_node_names())
+
+    def test_iter_collapse_creates_nodes_on_demand(self):
+        created = []
+        create_node = self.array.create_node
+        def counting_create_node(index):
+            created.append(index)
+            return create_node(index)
+        self.array.create_node = counting_create_node
+        leaves = self.array.iter_collapse()
+        self.assertEqual(next(leaves).get_string(), 'x1')
+        self.assertEqual(created, [0])
+
+    def test_from_generator(self):
+        array = OptionsArray.from_sequence('x', (i for i in range(1, 10, 2)),
+                                           name_format='x{}')
+        self.assertEqual(array.collapse(), self.expected.collapse())
+
+    def test_getitem(self):
+        self.assertEqual(self.array[1], self.expected[1])
+        self.assertEqual(self.array['x7'], self.expected['x7'])
+        self.assertEqual(self.array[-1], self.expected[-1])
+        self.assertRaises(IndexError, lambda: self.array[5])
+
+    def test_slice(self):
+        subarray = self.array[1:4:2]
+        self.assertIsInstance(subarray, VirtualOptionsArray)
+        self.assertEqual(list(subarray.values), [3, 7])
+        self.assertEqual(subarray.collapse(), self.expected[1:4:2].collapse())
+
+    def test_multiply_and_update(self):
+        for array in [self.array, self.expected]:
+            array.update({'foo': 1})
+            array *= OptionsArray('y', 'ab')
+            array.update({'bar': 2})
+        tree = self.array * OptionsNode('z')
+        self.assertEqual(tree.collapse(),
+                         (self.expected * OptionsNode('z')).collapse())
+        self.assertEqual(self.array.shape, (5, 2))
+        self.assertEqual(self.array.locate('x5_b')[0], 5)
+
+    def test_count_shape_and_leaves(self):
+        for array in [self.array, self.expected]:
+            array *= OptionsArray('y', 'ab')
+        self.assertEqual(self.array.count_leaves(), 10)
+        self.assertEqual(self.array.count_node_leaves(),
+                         self.expected.count_node_leaves())
+        self.assertEqual(self.array.shape, (5, 2))
+        self.assertEqual(self.array.split_leaf_index(7), (3, 1))
+        self.assertRaises(IndexError, self.array.split_leaf_index, 10)
+        self.assertEqual(self.array.leaf_offset(3), 6)
+        self.assertEqual(self.array.leaf(7), self.expected.leaf(7))
+        self.assertEqual(self.array.leaf(-1), self.expected.leaf(-1))
+
+    def test_locate(self):
+        self.assertEqual(self.array.get_name_index(),
+                         self.expected.get_name_index())
+        self.assertEqual(self.array.get_value_index(),
+                         self.expected.get_value_index())
+        self.assertEqual(self.array.locate('x7')[0], 3)
+        self.assertEqual(self.array.locate({'x': 5})[0], 2)
+        self.assertEqual(self.array.locate({'x': 'x9'})[0], 4)
+        self.assertEqual(self.array[1:3].locate('x5')[0], 1)
+        self.assertRaises(OptionsTreeElementException, self.array.locate,
+                          'x4')
+        self.array.update({'x': 0})
+        self.assertEqual(self.array.locate({'x': 0})[0], 0)
+
+    def test_modification_raises_error(self):
+        self.assertRaises(OptionsArrayException,
+                          lambda: self.array.append(OptionsNode('x11')))
+        self.assertRaises(OptionsArrayException, self.array.pop)
+        def delete():
+            del self.array[0]
+        self.assertRaises(OptionsArrayException, delete)
+
+    def test_materialize(self):
+        array = self.array.materialize()
+        self.assertNotIsInstance(array, VirtualOptionsArray)
+        array.append(OptionsNode('x11', {'x': 11}))
+        self.assertEqual(len(array.collapse()), 6)
+        self.assertEqual(len(self.array), 5)
+
+    def test_select(self):
+        view = self.array.select(x=[3, 5])
+        self.assertEqual([str(od) for od in view.collapse()], ['x3', 'x5'])
+
+
 class TestOptionsArrayWithHooks(unittest.TestCase):
     
     def test_apply_list_hooks(self):
@@ -278,6 +507,39 @@ class TestOptionsArrayWithHooks(unittest.TestCase):
         ods = array.collapse()
         self.assertEqual([od['A'] for od in ods], [1, 2, 3])
 
+    def test_apply_hooks_to_leaf(self):
+        array = OptionsArray('A', range(3), list_hooks=[list_function],
+                             item_hooks=[item_function])
+        self.assertEqual(array.leaf(0)['A'], 3)
+        array = OptionsArray('A', range(3), item_hooks=[item_function])
+        self.assertEqual(array.leaf(-1)['A'], 3)
+
+    def test_apply_hooks_to_shard(self):
+        array = OptionsArray('A', range(3), list_hooks=[list_function],
+                             item_hooks=[item_function])
+        ods = array.collapse(shard=1, num_shards=2, partition='strided')
+        self.assertEqual([od['A'] for od in ods], [2])
+
+    def test_apply_hooks_while_streaming(self):
+        array = OptionsArray('A', range(3), list_hooks=[list_function],
+                             item_hooks=[item_function])
+        ods = array.iter_collapse()
+        self.assertEqual([od['A'] for od in ods], [3, 2, 1])
+
+    def test_slice_keeps_hooks(self):
+        array = OptionsArray('A', range(4), list_hooks=[list_function],
+                             dict_hooks=[dict_function],
+                             item_hooks=[item_function])
+        view = array[1:3]
+        self.assertEqual(view.list_hooks, [list_function])
+        self.assertEqual(view.dict_hooks, [dict_function])
+        self.assertEqual(view.item_hooks, [item_function])
+        ods = view.collapse()
+        # reversed by the list hook; 'A' is set by the dict hook and
+        # incremented by the item hook
+        self.assertEqual([str(od) for od in ods], ['2', '1'])
+        self.assertEqual([od['A'] for od in ods], [0, 0])
+
 
 class TestOptionsArrayFactory(unittest.TestCase):
 
@@ -1,11 +1,12 @@
 import unittest
 from opiter.options_dict import OptionsDict, CallableOption, \
     OptionsDictException, transform_items, unlink, Check, Remove, Sequence, \
-    missing_dependencies, unpicklable
+    missing_dependencies, unpicklable, LayeredOptionsDict, PartialOptionsDict
 from opiter.options_node import OptionsNode
 from opiter.options_array import OptionsArray
 from opiter.formatters import SimpleFormatter, TreeFormatter
-from copy import deepcopy
+from opiter.node_info import NodeInfoException
+from copy import copy, deepcopy
 from math import sqrt
 
 
@@ -392,6 +393,137 @@ class TestTransformElementsFreeFunction(unittest.TestCase):
         self.assertEqual(self.dicts, [create_nested(1, 2, 3),
                                       create_nested(4, 5, 6)])
 
+
+class TestLayeredOptionsDict(unittest.TestCase):
+
+    def setUp(self):
+        self.layer = create_nested(1, 2, 3)
+        self.od = LayeredOptionsDict(self.layer)
+
+    def test_only_immutable_values_are_shared(self):
+        self.assertEqual(self.od, self.layer)
+        self.assertIs(dict.__getitem__(self.od, 'A'),
+                      dict.__getitem__(self.layer, 'A'))
+        self.assertIsNot(dict.__getitem__(self.od, 'B'),
+                         dict.__getitem__(self.layer, 'B'))
+
+    def test_set_item_leaves_layer_alone(self):
+        self.od['A'] = 10
+        self.assertEqual(self.od['A'], 10)
+        self.assertEqual(self.layer['A'], 1)
+
+    def test_transform_items_leaves_layer_alone(self):
+        self.od.transform_items(bump)
+        self.assertEqual(self.od, create_nested(2, 3, 4))
+        self.assertEqual(self.layer, create_nested(1, 2, 3))
+
+    def test_update_from_another_layer(self):
+        other_layer = OptionsDict({'B': {'C': 5}})
+        self.od.update(LayeredOptionsDict(other_layer))
+        self.od['B']['C'] += 1
+        self.assertEqual(other_layer['B'], {'C': 5})
+
+    def test_copies_leave_layer_alone(self):
+        for od in [copy(self.od), deepcopy(self.od)]:
+            self.assertIsInstance(od, LayeredOptionsDict)
+            self.assertEqual(od, self.layer)
+            od['B']['C'] += 1
+            self.assertEqual(self.layer, create_nested(1, 2, 3))
+        self.od['B']['C'] += 1
+        self.assertEqual(self.layer, create_nested(1, 2, 3))
+
+    def test_accessors_hand_out_copies(self):
+        layer_value = dict.__getitem__(self.layer, 'B')
+        accessors = [
+            lambda od: od.get('B'),
+            lambda od: od.setdefault('B'),
+            lambda od: dict(od.items())['B'],
+            lambda od: dict(od.iteritems())['B'],
+            lambda od: dict(od.viewitems())['B'],
+            lambda od: [v for v in od.values() if isinstance(v, dict)][0],
+            lambda od: [v for v in od.itervalues()
+                        if isinstance(v, dict)][0],
+            lambda od: od.copy()['B'],
+            lambda od: dict(od)['B'],
+            lambda od: od.pop('B')]
+        for accessor in accessors:
+            od = LayeredOptionsDict(self.layer)
+            value = accessor(od)
+            self.assertEqual(value, layer_value)
+            self.assertIsNot(value, layer_value)
+        self.assertIs(dict.__getitem__(self.layer, 'B'), layer_value)
+
+
+class TestOptionsDictCopies(unittest.TestCase):
+
+    def setUp(self):
+        tree = OptionsArray('A', [1, 2]) * OptionsArray('B', [3])
+        tree.update({'C': [4], 'D': 'text'})
+        self.od = tree.collapse()[1]
+
+    def test_deepcopy(self):
+        od = deepcopy(self.od)
+        self.assertEqual(od, self.od)
+        self.assertEqual(str(od), '2_3')
+        self.assertIsNot(od['C'], self.od['C'])
+        self.assertIs(od['D'], self.od['D'])
+        # node information is copied, apart from the names
+        ni, other_ni = od.get_node_info(), self.od.get_node_info()
+        self.assertIsNot(ni, other_ni)
+        self.assertIsNot(ni.position, other_ni.position)
+        self.assertIs(ni.node_names, other_ni.node_names)
+
+    def test_deepcopy_keeps_identities_within_copy(self):
+        self.od['E'] = self.od['C']
+        od = deepcopy(self.od)
+        self.assertIs(od['C'], od['E'])
+
+    def test_copy(self):
+        od = copy(self.od)
+        self.assertEqual(od, self.od)
+        self.assertIs(od['C'], self.od['C'])
+        od.update(OptionsDict({'F': 0}))
+        self.assertEqual(len(self.od._node_info), 2)
+
+
+class TestPartialOptionsDict(unittest.TestCase):
+
+    def setUp(self):
+        self.od = PartialOptionsDict({'A': 1, 'B': lambda opt: opt['C']})
+
+    def test_records_accessed_keys(self):
+        self.od['A']
+        self.od.get('D')
+        'E' in self.od
+        self.assertEqual(self.od._accessed_keys, set(['A', 'D', 'E']))
+        self.assertFalse(self.od._all_keys_accessed)
+
+    def test_records_keys_of_dependencies(self):
+        self.assertRaises(KeyError, lambda: self.od['B'])
+        self.assertEqual(self.od._accessed_keys, set(['B', 'C']))
+
+    def test_records_access_to_all_keys(self):
+        self.od.items()
+        self.assertTrue(self.od._all_keys_accessed)
+
+    def test_records_access_to_all_keys_through_copy(self):
+        self.assertEqual(dict(self.od.copy())['A'], 1)
+        self.assertTrue(self.od._all_keys_accessed)
+
+    def test_records_access_to_all_keys_through_dict(self):
+        od = PartialOptionsDict({'A': 1})
+        self.assertEqual(dict(od), {'A': 1})
+        self.assertTrue(od._all_keys_accessed)
+
+    def test_merge_records_nothing(self):
+        self.od.merge({'C': 2})
+        self.assertFalse(self.od.defines('D'))
+        self.assertEqual(self.od._accessed_keys, set())
+        self.assertEqual(self.od['B'], 2)
+
+    def test_node_info_is_unavailable(self):
+        self.assertRaises(NodeInfoException, lambda: str(self.od))
+
         
 class TestCallableOption(unittest.TestCase):
 
@@ -1,10 +1,14 @@
 import unittest
-from opiter.options_tree_elements import product
-from opiter.options_array import OptionsArray
+from opiter.options_tree_elements import product, diff, \
+    OptionsTreeElementException
+from opiter.options_array import OptionsArray, OptionsArrayException, \
+    from_spec
 from opiter.options_array import OptionsNode
-from opiter.options_dict import OptionsDict, Lookup, transform_items, unlink
+from opiter.options_dict import OptionsDict, Lookup, transform_items, \
+    unlink, Exclude
 from multiprocessing import Pool
 from copy import deepcopy
+import json
 
 
 # ---------------------------------------------------------------------
@@ -21,6 +25,14 @@ def add_dependent_item(tree_element):
     tree_element.update({'product': lambda opt: \
                          (1 + 'ABC'.index(opt['letter'])) * opt['number']})
 
+
+def letter_product(opt):
+    """
+    The dependent item added by add_dependent_item, defined at module
+    level so that it can be referred to in a tree spec.
+    """
+    return (1 + 'ABC'.index(opt['letter'])) * opt['number']
+
         
 def make_tree_str(options_dicts):
     result_str = ''
@@ -361,6 +373,23 @@ letter: C
         self.help_test_addition_with_array(
             Sum([self.array, self.other_array]))
 
+    def test_addition_with_arrays_of_other_lengths(self):
+        # leftover nodes are dropped, and leftover leaves are left alone
+        longer = OptionsArray('number', range(5))
+        shorter = OptionsArray('number', range(2))
+        self.assertEqual([str(od) for od in (self.array + longer).collapse()],
+                         ['A_0', 'B_1', 'C_2'])
+        self.assertEqual([str(od) for od in (self.array + shorter).collapse()],
+                         ['A_0', 'B_1', 'C'])
+        self.assertEqual([str(od) for od in longer.collapse()],
+                         ['0', '1', '2', '3', '4'])
+        remainder = self.array.attach(longer)
+        self.assertIsInstance(remainder, OptionsArray)
+        self.assertEqual([str(od) for od in remainder.collapse()],
+                         ['3', '4'])
+        self.assertEqual([od['number'] for od in remainder.collapse()],
+                         [3, 4])
+
         
     def help_test_multiplication_with_array(self, operation):
         expected_names = ['A_0', 'A_1', 'A_2',
@@ -756,6 +785,630 @@ letter: B
     def test_count_leaves(self):
         self.assertEqual(self.tree.count_leaves(), 4)
 
+    def test_count_leaves_after_changes(self):
+        self.assertEqual(self.tree.count_leaves(), 4)
+        self.tree[0] *= self.array
+        self.assertEqual(self.tree.count_leaves(), 8)
+        self.tree.append(OptionsNode('C'))
+        self.assertEqual(self.tree.count_leaves(), 9)
+        self.tree[1][0] = 5
+        self.tree[1] += self.node
+        del self.tree[0][0]
+        self.assertEqual(self.tree.count_leaves(), 6)
+        self.tree.pop()
+        self.assertEqual(self.tree.count_leaves(), 5)
+        self.assertEqual(self.tree.count_leaves(),
+                         len(self.tree.collapse()))
+
+    def test_shape(self):
+        self.assertEqual(self.tree.shape, (2, 2))
+        self.tree *= self.array
+        self.assertEqual(self.tree.shape, (2, 2, 3))
+        self.assertEqual(self.tree[1].shape, (2, 3))
+        self.assertEqual((OptionsNode('root') * self.tree).shape, (2, 2, 3))
+
+    def test_shape_of_irregular_tree(self):
+        self.tree[0] *= self.array
+        self.assertEqual(self.tree.shape, None)
+        self.assertEqual(self.tree[1].shape, (2,))
+
+    def test_shape_cache_survives_changes_to_other_trees(self):
+        other = 1 * self.tree
+        self.assertEqual(other.shape, (2, 2))
+        self.tree *= self.array
+        self.assertIsNotNone(other.leaf_count)
+        self.assertEqual(other.shape, (2, 2))
+        self.assertEqual(self.tree.shape, (2, 2, 3))
+
+    def test_shape_after_changing_handles(self):
+        child = self.tree[1].child
+        self.assertEqual(self.tree.shape, (2, 2))
+        child.append(OptionsNode('2'))
+        self.assertEqual(self.tree.shape, None)
+        self.assertEqual(self.tree.count_leaves(), 5)
+        self.tree[0].child = OptionsArray('number', range(3))
+        self.assertEqual(self.tree.shape, (2, 3))
+
+    def test_multiplication_shares_subtree(self):
+        self.assertIs(self.tree._nodes[0]._child, self.tree._nodes[1]._child)
+
+    def test_update_keeps_subtree_shared(self):
+        self.tree.update({'foo': 'bar'})
+        self.assertIs(self.tree._nodes[0]._child, self.tree._nodes[1]._child)
+        self.assertEqual([od['foo'] for od in self.tree.collapse()],
+                         ['bar'] * 4)
+
+    def test_update_through_node_copies_shared_subtree(self):
+        self.tree[0].update({'foo': 'bar'})
+        self.assertIsNot(self.tree._nodes[0]._child, self.tree._nodes[1]._child)
+        self.assertEqual(['foo' in od for od in self.tree.collapse()],
+                         [True, True, False, False])
+
+    def test_setitem_through_node_copies_shared_subtree(self):
+        self.tree[1][0] = 'x'
+        self.assertEqual([str(od) for od in self.tree.collapse()],
+                         ['A_0', 'A_1', 'B_x', 'B_1'])
+
+    def test_update_beneath_shared_subtree(self):
+        # the array that gets shared is two levels down from tree[0]
+        self.tree = OptionsArray('letter', ['A', 'B'])
+        self.tree[0] *= self.node
+        self.tree *= OptionsArray('number', range(2))
+        self.tree[0].update({'foo': 'bar'})
+        self.assertEqual(['foo' in od for od in self.tree.collapse()],
+                         [True, True, False, False])
+
+    def test_multiplication_shares_operands(self):
+        result = self.tree * self.node
+        self.assertIsNot(result, self.tree)
+        self.assertIs(result._nodes[0]._child._nodes[0]._options_dict,
+                      self.tree._nodes[0]._child._nodes[0]._options_dict)
+        self.assertEqual([str(od) for od in self.tree.collapse()],
+                         ['A_0', 'A_1', 'B_0', 'B_1'])
+        self.assertEqual([str(od) for od in result.collapse()],
+                         ['A_0_i', 'A_1_i', 'B_0_i', 'B_1_i'])
+
+    def test_update_through_child_copies_shared_subtree(self):
+        tree = OptionsArray('p', [1, 2]) * OptionsArray('q', [1, 2])
+        tree[0].child.update({'q3': 3})
+        self.assertEqual([od.get('q3') for od in tree.collapse()],
+                         [3, 3, None, None])
+        tree.get_children()[1].update({'q4': 4})
+        self.assertEqual([od.get('q4') for od in tree.collapse()],
+                         [None, None, 4, 4])
+
+    def test_copy_leaves_handles_alone(self):
+        node = self.tree[0]
+        result = 1 * self.tree
+        node.update({'foo': 'bar'})
+        self.assertEqual(['foo' in od for od in self.tree.collapse()],
+                         [True, True, False, False])
+        self.assertNotIn('foo', result.collapse()[0])
+
+    def test_handles_survive_copy_and_further_reads(self):
+        node = self.tree[0]
+        result = 1 * self.tree
+        self.assertIs(self.tree[0], node)
+        node.update({'foo': 'bar'})
+        node.options_dict['baz'] = 1
+        self.assertEqual(['foo' in od for od in self.tree.collapse()],
+                         [True, True, False, False])
+        self.assertEqual(['baz' in od for od in self.tree.collapse()],
+                         [True, True, False, False])
+        self.assertNotIn('baz', result.collapse()[0])
+
+    def test_modifying_copy_leaves_operand_alone(self):
+        result = 1 * self.tree
+        result[1].options_dict['foo'] = 'bar'
+        result[0][0].update({'baz': 1})
+        self.assertEqual(['foo' in od for od in result.collapse()],
+                         [False, False, True, True])
+        for od in self.tree.collapse():
+            self.assertNotIn('foo', od)
+            self.assertNotIn('baz', od)
+
+    def test_modifying_nodes_through_nodes_list(self):
+        tree = OptionsArray('letter', ['A', 'B']) * \
+               OptionsArray('number', range(2))
+        tree.nodes[0].child.nodes[0].options_dict['x'] = 1
+        tree.nodes[0].child.nodes[1].update({'y': 2})
+        tree.nodes[1].child.nodes[0].child = OptionsNode('i')
+        self.assertEqual([str(od) for od in tree.collapse()],
+                         ['A_0', 'A_1', 'B_0_i', 'B_1'])
+        self.assertEqual([('x' in od, 'y' in od) for od in tree.collapse()],
+                         [(True, False), (False, True),
+                          (False, False), (False, False)])
+
+    def test_assigning_nodes(self):
+        array = OptionsArray('number', range(2))
+        array.nodes = [OptionsNode('x'), OptionsNode('y'), OptionsNode('z')]
+        self.assertEqual(array.count_leaves(), 3)
+
+    def test_addition_copies_only_changed_path(self):
+        result = self.tree + self.node
+        self.assertIsNot(result._nodes[0], self.tree._nodes[0])
+        self.assertIs(result._nodes[1], self.tree._nodes[1])
+        self.assertEqual([str(od) for od in self.tree.collapse()],
+                         ['A_0', 'A_1', 'B_0', 'B_1'])
+
+    def test_product_of_many_arrays(self):
+        arrays = [OptionsArray(str(k), range(3)) for k in range(6)]
+        result = product(arrays)
+        self.assertEqual(result.collapse(),
+                         (arrays[0] * arrays[1] * arrays[2] * arrays[3] *
+                          arrays[4] * arrays[5]).collapse())
+        # the partial product beneath each level is shared
+        self.assertIs(result._nodes[0]._child, result._nodes[2]._child)
+        self.assertIs(result._nodes[0]._child._nodes[0]._child,
+                      result._nodes[1]._child._nodes[2]._child)
+
+    def test_product_with_constraints(self):
+        letters = OptionsArray('letter', ['A', 'B', 'C'])
+        numbers = OptionsArray('number', range(3))
+        result = product([letters, numbers, self.array], constraints=[
+            Exclude(letter='B', number=1),
+            lambda od: od['subnumber'] == 'iii' and od['number'] == 0])
+        names = [str(od) for od in result.collapse()]
+        self.assertEqual(len(names), 3 * 3 * 3 - 3 - 3)
+        self.assertNotIn('B_1_i', names)
+        self.assertNotIn('C_0_iii', names)
+        self.assertEqual(result.count_leaves(), len(names))
+        # the B branch has lost a number node; A and C still share
+        # theirs
+        self.assertEqual(len(result[1].child.nodes), 2)
+        self.assertIs(result._nodes[0]._child, result._nodes[2]._child)
+
+    def test_constrain_with_item_redefined_below(self):
+        self.tree[1][0].update({'letter': 'A'})
+        result = self.tree.constrain([Exclude(letter='B')])
+        self.assertEqual([str(od) for od in result.collapse()],
+                         ['A_0', 'A_1', 'B_0'])
+
+    def test_constrain_shared_subtree_with_item_defined_later(self):
+        # the velocity subtree is shared between a parent that lacks
+        # the fluid item and one that defines it
+        group = OptionsArray('group', [OptionsNode('x'),
+                                       OptionsNode('y', {'fluid': 'ethanol'})])
+        velocities = OptionsArray('velocity', [0.02, 0.04])
+        constraints = [Exclude(fluid='ethanol', velocity=0.04)]
+        expected = ['x_0.02', 'x_0.04', 'y_0.02']
+        result = (group * velocities).constrain(constraints)
+        self.assertEqual([str(od) for od in result.collapse()], expected)
+        result = product([group, velocities], constraints=constraints)
+        self.assertEqual([str(od) for od in result.collapse()], expected)
+
+    def test_constrain_looking_at_whole_dict(self):
+        self.tree[1][1].update({'flag': True})
+        for constraint in [lambda od: 'flag' not in od.copy(),
+                           lambda od: 'flag' not in dict(od),
+                           lambda od: 'flag' not in od.viewkeys()]:
+            result = self.tree.constrain([constraint])
+            self.assertEqual([str(od) for od in result.collapse()], ['B_1'])
+
+    def test_constrain_everything(self):
+        self.assertIs(self.tree.constrain([lambda od: True]), None)
+
+    def test_product_of_one_or_no_elements(self):
+        result = product([self.tree])
+        self.assertIsNot(result, self.tree)
+        self.assertEqual(result, self.tree)
+        self.assertEqual(product([]), 1)
+
+    def test_multiplication_by_enclosing_tree(self):
+        node = self.tree[0]
+        node *= self.tree
+        self.assertEqual([str(od) for od in self.tree.collapse()][:3],
+                         ['A_0_A_0', 'A_0_A_1', 'A_0_B_0'])
+        self.assertEqual(self.tree.count_leaves(), 10)
+
+    def test_collapse_where(self):
+        where = lambda od: od['product'] % 2 == 0
+        self.assertEqual([str(od) for od in self.tree.collapse(where=where)],
+                         ['A_0', 'B_0', 'B_1'])
+
+    def test_collapse_where_skips_subtree(self):
+        self.tree *= self.array
+        calls = []
+        def where(od):
+            calls.append(od)
+            return od['letter'] == 'A'
+        ods = self.tree.collapse(where=where)
+        self.assertEqual(len(ods), 6)
+        # both letter nodes, the number nodes under A and the A leaves,
+        # but nothing in the B subtree
+        self.assertEqual(len(calls), 2 + 2 + 6)
+        self.assertEqual(ods, [od for od in self.tree.collapse()
+                               if where(od)])
+
+    def test_collapse_where_with_item_redefined_below(self):
+        self.tree[1][0].update({'letter': 'A'})
+        where = lambda od: od['letter'] == 'A'
+        self.assertEqual([str(od) for od in self.tree.collapse(where=where)],
+                         ['A_0', 'A_1', 'B_0'])
+
+    def test_collapse_where_looking_at_whole_dict(self):
+        self.tree[1][1].update({'flag': True})
+        for where in [lambda od: 'flag' in od.copy(),
+                      lambda od: 'flag' in dict(od),
+                      lambda od: 'flag' in od.viewkeys(),
+                      lambda od: ('flag', True) in od.viewitems()]:
+            self.assertEqual(
+                [str(od) for od in self.tree.collapse(where=where)],
+                ['B_1'])
+
+    def test_collapse_where_with_hooks_below(self):
+        def rename(od):
+            od['letter'] = 'A'
+        self.tree[1][1].dict_hooks = [rename]
+        where = lambda od: od['letter'] == 'A'
+        self.assertEqual([str(od) for od in self.tree.collapse(where=where)],
+                         ['A_0', 'A_1', 'B_1'])
+
+    def test_walk(self):
+        self.assertEqual([str(el) for el in self.tree.walk()],
+                         ['letter', 'A', 'number', '0', '1',
+                          'B', 'number', '0', '1'])
+
+    def test_operations_on_deep_tree(self):
+        # deeper than the recursion limit
+        depth = 2000
+        root = node = OptionsNode('0')
+        for i in range(1, depth):
+            node.child = OptionsNode(str(i))
+            node = node.child
+        root.update({'foo': 'bar'})
+        root *= self.tree
+        root += OptionsNode('i')
+        self.assertEqual(root.count_leaves(), 4)
+        ods = root.collapse()
+        self.assertEqual(str(ods[0]).split('_')[-4:],
+                         [str(depth - 1), 'A', '0', 'i'])
+        self.assertEqual(ods[3]['foo'], 'bar')
+        self.assertEqual(root.leaf(3), ods[3])
+        self.assertEqual(root.locate(ods[3].get_string())[0], 3)
+        self.assertEqual(root.locate({'letter': 'B', 'number': 1})[0], 3)
+        self.assertEqual(root.select(letter='B').count_leaves(), 2)
+        constrained = root.constrain([lambda od: od['number'] == 0])
+        self.assertEqual([od.get_string() for od in constrained.collapse()],
+                         [od.get_string() for od in ods[1::2]])
+
+    def test_copying_deep_tree(self):
+        # deeper than the recursion limit
+        depth = 2000
+        root = node = OptionsNode('0')
+        for i in range(1, depth):
+            node.child = OptionsNode(str(i))
+            node = node.child
+        array = OptionsArray('array', [root])
+        self.assertEqual(array.count_leaves(), 1)
+        root *= root
+        self.assertEqual(root.count_leaves(), 1)
+        self.assertEqual(len(str(root.collapse()[0]).split('_')), 2 * depth)
+        copied = deepcopy(root)
+        self.assertEqual(copied.collapse(), root.collapse())
+
+    def test_iter_collapse(self):
+        leaves = self.tree.iter_collapse()
+        self.assertEqual(str(next(leaves)), 'A_0')
+        self.assertEqual([od.get_string() for od in leaves],
+                         ['A_1', 'B_0', 'B_1'])
+
+    def test_iter_collapse_matches_collapse(self):
+        self.tree.update({'foo': 'bar'})
+        self.assertEqual(list(self.tree.iter_collapse()),
+                         self.tree.collapse())
+
+    def test_leaf(self):
+        ods = self.tree.collapse()
+        for i in range(-4, 4):
+            self.assertEqual(self.tree.leaf(i), ods[i])
+        self.assertRaises(IndexError, lambda: self.tree.leaf(4))
+
+    def test_leaf_of_irregular_tree(self):
+        self.tree[0] *= self.array
+        self.tree.update({'foo': 'bar'})
+        ods = self.tree.collapse()
+        self.assertEqual([self.tree.leaf(i) for i in range(len(ods))], ods)
+        self.assertEqual(str(self.tree.leaf(5)), 'A_1_iii')
+
+    def test_leaf_with_list_hooks_below_root(self):
+        def drop_first(ods):
+            del ods[0]
+        tree = OptionsArray('a', [1, 2]) * \
+               OptionsArray('b', [3, 4, 5], list_hooks=[drop_first])
+        ods = tree.collapse()
+        self.assertEqual(len(ods), 4)
+        for i in range(-4, 4):
+            self.assertEqual(tree.leaf(i), ods[i])
+        self.assertRaises(IndexError, lambda: tree.leaf(4))
+
+    def test_leaf_after_assigning_list_hooks(self):
+        self.assertEqual(str(self.tree.leaf(0)), 'A_0')
+        self.assertFalse(self.tree.has_list_hooks_below())
+        self.tree[1].child.list_hooks = [lambda ods: ods.reverse()]
+        self.assertTrue(self.tree.has_list_hooks_below())
+        self.assertEqual([str(self.tree.leaf(i)) for i in range(4)],
+                         ['A_0', 'A_1', 'B_1', 'B_0'])
+        self.tree[1].child.list_hooks = []
+        self.assertFalse(self.tree.has_list_hooks_below())
+        self.assertEqual(str(self.tree.leaf(2)), 'B_0')
+
+    def test_locate_from_name(self):
+        index, od = self.tree.locate('B_0')
+        self.assertEqual(index, 2)
+        self.assertEqual(od, self.tree.collapse()[2])
+
+    def test_locate_from_items(self):
+        index, od = self.tree.locate({'letter': 'B', 'number': 1})
+        self.assertEqual(index, 3)
+        self.assertEqual(od['product'], 2)
+
+    def test_locate_in_irregular_tree(self):
+        self.tree[0] *= self.array
+        self.assertEqual(self.tree.locate('A_1_ii')[0], 4)
+        self.assertEqual(self.tree.locate('B_1')[0], 7)
+        self.assertEqual(
+            self.tree.locate({'letter': 'A', 'number': 0,
+                              'subnumber': 'iii'})[0], 2)
+
+    def test_locate_with_list_hooks(self):
+        def drop_first(ods):
+            del ods[0]
+        self.tree[0] *= OptionsArray('subnumber', ['i', 'ii'],
+                                     list_hooks=[drop_first])
+        self.tree.list_hooks = [lambda ods: ods.reverse()]
+        ods = self.tree.collapse()
+        self.assertEqual([str(od) for od in ods],
+                         ['B_1', 'B_0', 'A_1_ii', 'A_0_ii'])
+        index, od = self.tree.locate('A_1_ii')
+        self.assertEqual(index, 2)
+        self.assertEqual(od, ods[2])
+        index, od = self.tree.locate({'letter': 'B', 'number': 0})
+        self.assertEqual(index, 1)
+        self.assertEqual(od['product'], 0)
+        # removed by a list hook
+        self.assertRaises(OptionsTreeElementException,
+                          lambda: self.tree.locate('A_0_i'))
+
+    def test_locate_missing_leaf(self):
+        self.assertRaises(OptionsTreeElementException,
+                          lambda: self.tree.locate('B_2'))
+        self.assertRaises(OptionsTreeElementException,
+                          lambda: self.tree.locate({'letter': 'C',
+                                                    'number': 1}))
+
+    def test_locate_from_incomplete_items(self):
+        self.assertRaises(OptionsArrayException,
+                          lambda: self.tree.locate({'letter': 'B'}))
+
+    def check_shards(self, num_shards, partition, expected_names):
+        shards = [self.tree.collapse(shard=k, num_shards=num_shards,
+                                     partition=partition)
+                  for k in range(num_shards)]
+        self.assertEqual([[str(od) for od in ods] for ods in shards],
+                         expected_names)
+
+    def test_blocked_shards(self):
+        self.tree[0] *= self.array
+        self.check_shards(3, 'blocked', [
+            ['A_0_i', 'A_0_ii'], ['A_0_iii', 'A_1_i', 'A_1_ii'],
+            ['A_1_iii', 'B_0', 'B_1']])
+
+    def test_strided_shards(self):
+        self.tree[0] *= self.array
+        self.check_shards(3, 'strided', [
+            ['A_0_i', 'A_1_i', 'B_0'], ['A_0_ii', 'A_1_ii', 'B_1'],
+            ['A_0_iii', 'A_1_iii']])
+
+    def test_shards_with_list_hooks_below_root(self):
+        def drop_first(ods):
+            del ods[0]
+        def repeat_last(ods):
+            ods.append(deepcopy(ods[-1]))
+        for hook in [drop_first, repeat_last]:
+            tree = OptionsArray('a', [1, 2, 3]) * \
+                   OptionsArray('b', [4, 5], list_hooks=[hook])
+            full = [str(od) for od in tree.collapse()]
+            for partition in ['blocked', 'strided']:
+                shards = [[str(od) for od in tree.collapse(
+                    shard=k, num_shards=3, partition=partition)]
+                          for k in range(3)]
+                if partition == 'strided':
+                    self.assertEqual(shards, [full[k::3] for k in range(3)])
+                else:
+                    self.assertEqual(sum(shards, []), full)
+
+    def test_more_shards_than_leaves(self):
+        self.check_shards(5, 'blocked', [[], ['A_0'], ['A_1'], ['B_0'],
+                                         ['B_1']])
+
+    def test_bad_shard(self):
+        self.assertRaises(OptionsTreeElementException,
+                          lambda: self.tree.collapse(shard=2, num_shards=2))
+        self.assertRaises(OptionsTreeElementException,
+                          lambda: self.tree.collapse(shard=0, num_shards=2,
+                                                     partition='random'))
+
+    def test_layered_collapse_matches_collapse(self):
+        self.tree.update({'foo': {'bar': 1}})
+        self.assertEqual(self.tree.collapse(layered=True),
+                         self.tree.collapse())
+
+    def test_layered_collapse_leaves_tree_alone(self):
+        self.tree.update({'foo': {'bar': 1}})
+        ods = self.tree.collapse(layered=True)
+        ods[0]['foo']['bar'] = 2
+        ods[1]['number'] = 5
+        self.assertEqual([od['foo']['bar'] for od in ods], [2, 1, 1, 1])
+        for od in self.tree.collapse():
+            self.assertEqual(od['foo']['bar'], 1)
+        self.assertEqual([od['number'] for od in self.tree.collapse()],
+                         [0, 1, 0, 1])
+
+    def test_layered_collapse_copies_mutable_values(self):
+        self.tree.update({'foo': [1], 'bar': 'text'})
+        leaf_node = self.tree.nodes[0].child.nodes[0]
+        od = self.tree.collapse(layered=True)[0]
+        self.assertIs(dict.__getitem__(od, 'bar'),
+                      dict.__getitem__(leaf_node.options_dict, 'bar'))
+        # not even dict() reaches the tree's own values
+        dict(od)['foo'].append(9)
+        self.assertEqual([od['foo'] for od in self.tree.collapse()],
+                         [[1]] * 4)
+        self.assertEqual(self.tree.collapse(layered=True)[1]['foo'], [1])
+
+    def test_subtree_versions(self):
+        self.tree.refresh_versions()
+        versions = [self.tree.subtree_version, self.tree[0].subtree_version]
+        self.tree.refresh_versions()
+        self.assertIs(self.tree.subtree_version, versions[0])
+        self.tree[1].update({'foo': 1})
+        self.tree.refresh_versions()
+        self.assertIsNot(self.tree.subtree_version, versions[0])
+        self.assertIs(self.tree[0].subtree_version, versions[1])
+
+    def test_memoised_layered_collapse(self):
+        calls = []
+        self.tree.dict_hooks = [calls.append]
+        first = self.tree.collapse(layered=True, memoise=True)
+        first[0]['number'] = 5
+        self.assertEqual(self.tree.collapse(layered=True, memoise=True),
+                         self.tree.collapse(memoise=True))
+        self.assertEqual(len(calls), 8)
+        self.tree.update({'foo': 1})
+        self.assertEqual(self.tree.collapse(layered=True, memoise=True),
+                         self.tree.collapse(memoise=True))
+
+    def test_memoised_collapse_after_editing_options_dict(self):
+        self.tree.collapse(layered=True, memoise=True)
+        self.tree.collapse(memoise=True)
+        self.tree[0].options_dict['x'] = 5
+        self.assertEqual([od.get('x') for od in
+                          self.tree.collapse(layered=True,
+                                             memoise=True)],
+                         [5, 5, None, None])
+        self.assertEqual([od.get('x') for od in
+                          self.tree.collapse(memoise=True)],
+                         [5, 5, None, None])
+        # changes through a reference the client holds on to count too
+        options_dict = self.tree[1].options_dict
+        self.tree.collapse(layered=True, memoise=True)
+        options_dict['x'] = 2
+        del self.tree[0].options_dict['x']
+        self.assertEqual([od.get('x') for od in
+                          self.tree.collapse(layered=True,
+                                             memoise=True)],
+                         [None, None, 2, 2])
+
+    def test_memoised_collapse_returns_copies(self):
+        first = self.tree.collapse(memoise=True)
+        first[0]['number'] = 5
+        self.assertEqual([od['number'] for od in
+                          self.tree.collapse(memoise=True)],
+                         [0, 1, 0, 1])
+
+    def test_collapse_after_modifying_held_value(self):
+        values = [1]
+        self.tree.update({'values': values})
+        self.tree.collapse()
+        values.append(2)
+        self.assertEqual([od['values'] for od in self.tree.collapse()],
+                         [[1, 2]] * 4)
+
+    def test_collapse_with_stateful_hook(self):
+        calls = []
+        def count(od):
+            calls.append(od)
+            od['calls'] = len(calls)
+        self.tree.dict_hooks = [count]
+        self.tree.collapse()
+        self.assertEqual([od['calls'] for od in self.tree.collapse()],
+                         [5, 6, 7, 8])
+        self.assertIs(self.tree.collapse_memo, None)
+
+    def test_deepcopy(self):
+        tree = deepcopy(self.tree)
+        self.assertEqual(tree.collapse(), self.tree.collapse())
+        # the nodes of the second array are shared by both letters
+        self.assertIs(tree._nodes[0]._child, tree._nodes[1]._child)
+        self.assertIsNot(tree._nodes[0]._child, self.tree._nodes[0]._child)
+        self.assertIs(tree.tags, self.tree.tags)
+        tree.update({'foo': 1})
+        self.assertNotIn('foo', self.tree.collapse()[0])
+        self.assertEqual(tree.collapse(incremental=True), tree.collapse())
+
+    def test_equality_and_hash(self):
+        make_tree = lambda: OptionsArray('letter', ['A', 'B']) * \
+                            OptionsArray('number', range(2))
+        self.assertEqual(make_tree(), make_tree())
+        self.assertEqual(hash(make_tree()), hash(make_tree()))
+        copied = deepcopy(self.tree)
+        self.assertEqual(copied, self.tree)
+        self.assertEqual({self.tree: 1}[copied], 1)
+        copied[1][0].update({'foo': 1})
+        self.assertNotEqual(copied, self.tree)
+        self.assertNotEqual(hash(copied), hash(self.tree))
+        self.assertNotEqual(self.tree, OptionsNode('letter') * self.array)
+        self.assertNotEqual(self.tree, self.od)
+
+    def test_equality_after_direct_modification(self):
+        self.assertEqual(deepcopy(self.tree), self.tree)
+        copied = deepcopy(self.tree)
+        copied.nodes[0].child.nodes[0].options_dict['x'] = 5
+        self.assertNotEqual(copied, self.tree)
+        self.assertNotEqual(self.tree, copied)
+
+    def test_hash_after_direct_modification(self):
+        array = OptionsArray('a', [1, 2])
+        hash(array)
+        array[0].options_dict['q'] = 1
+        other = OptionsArray('a', [1, 2])
+        other[0].update({'q': 1})
+        self.assertEqual(array, other)
+        self.assertEqual(hash(array), hash(other))
+        self.assertEqual({other: 1}[array], 1)
+
+    def test_incremental_collapse_matches_collapse(self):
+        self.tree.collapse(incremental=True)
+        self.tree[1].update({'foo': 1})
+        self.assertEqual(self.tree.collapse(incremental=True),
+                         self.tree.collapse())
+        self.tree.append(OptionsNode('C'))
+        self.assertEqual(self.tree.collapse(incremental=True),
+                         self.tree.collapse())
+
+    def test_incremental_collapse_reuses_unchanged_leaves(self):
+        self.tree.collapse(incremental=True)
+        cache_a = self.tree[0].leaf_cache
+        cache_b = self.tree[1].leaf_cache
+        self.tree[1].update({'foo': 1})
+        ods = self.tree.collapse(incremental=True)
+        self.assertIs(self.tree[0].leaf_cache, cache_a)
+        self.assertIsNot(self.tree[1].leaf_cache, cache_b)
+        self.assertEqual([od.get('foo') for od in ods], [None, None, 1, 1])
+
+    def test_incremental_collapse_after_editing_options_dict(self):
+        self.tree.collapse(incremental=True)
+        self.tree[1]['1'].options_dict['y'] = 1
+        ods = self.tree.collapse(incremental=True)
+        self.assertEqual([od.get('y') for od in ods], [None, None, None, 1])
+
+    def test_incremental_collapse_leaves_cache_alone(self):
+        self.tree.update({'foo': {'bar': 1}})
+        ods = self.tree.collapse(incremental=True)
+        ods[0]['foo']['bar'] = 2
+        ods[1]['number'] = 5
+        ods = self.tree.collapse(incremental=True)
+        self.assertEqual([od['foo']['bar'] for od in ods], [1, 1, 1, 1])
+        self.assertEqual([od['number'] for od in ods], [0, 1, 0, 1])
+
+    def test_incremental_collapse_after_hooks_change(self):
+        self.tree.collapse(incremental=True)
+        self.tree.list_hooks = [lambda ods: ods.reverse()]
+        self.assertEqual(
+            [od.get_string() for od in self.tree.collapse(incremental=True)],
+            ['B_1', 'B_0', 'A_1', 'A_0'])
+
 
     # now test set-item operations
             
@@ -847,6 +1500,30 @@ letter: B
         check_result(self, self.tree[1:2], expected_names, expected_tree_str)
 
 
+    def test_select(self):
+        view = self.tree.select(letter='B', number=[1, 2])
+        ods = view.collapse()
+        self.assertEqual([str(od) for od in ods], ['root_B_1'])
+        self.assertTrue(ods[0].get_node_info('letter').position.is_at(0))
+        self.assertEqual(len(self.tree.collapse()), 4)
+
+    def test_select_shares_unaffected_branches(self):
+        view = self.tree.select(letter='B')
+        self.assertIs(view._child._nodes[0]._child,
+                      self.tree._child._nodes[1]._child)
+        self.assertIsNone(self.tree.select(letter='C'))
+
+    def test_select_everything_returns_copy(self):
+        view = self.tree.select(letter=['A', 'B'])
+        self.assertIsNot(view, self.tree)
+        view.update({'foo': 1})
+        self.assertNotIn('foo', self.tree.collapse()[0])
+
+    def test_locate_through_root_node(self):
+        self.assertEqual(self.tree.locate('root_B_0')[0], 2)
+        self.assertEqual(
+            self.tree.locate({'letter': 'A', 'number': 1})[0], 1)
+
     def test_item_incremental_addition_with_node(self):
         expected_names = ['root_A_0', 'root_A_1', 'root_B_0_i', 'root_B_1']
         expected_tree_str = """
@@ -877,6 +1554,137 @@ root
         op.check(self, expected_names, expected_tree_str)
         
 
+
+class TestDiff(unittest.TestCase):
+
+    def setUp(self):
+        letters = OptionsArray('letter', ['A', 'B'])
+        numbers = OptionsArray('number', range(2))
+        self.tree = OptionsNode('root') * letters * numbers
+
+    def test_diff_of_same_tree(self):
+        self.assertEqual(diff(self.tree, self.tree), ([], [], {}))
+        self.assertEqual(diff(self.tree, deepcopy(self.tree)), ([], [], {}))
+
+    def test_diff_after_extending(self):
+        letters = OptionsArray('letter', ['B', 'C'])
+        numbers = OptionsArray('number', range(3))
+        new_tree = OptionsNode('root') * letters * numbers
+        self.assertEqual(diff(self.tree, new_tree),
+                         (['root_B_2', 'root_C_0', 'root_C_1', 'root_C_2'],
+                          ['root_A_0', 'root_A_1'], {}))
+
+    def test_diff_after_update(self):
+        new_tree = 1 * self.tree
+        new_tree[1].update({'letter': 'C', 'foo': 1})
+        self.assertEqual(diff(self.tree, new_tree),
+                         ([], [], {'root_B_0': ['foo', 'letter'],
+                                   'root_B_1': ['foo', 'letter']}))
+
+    def test_diff_with_leaf_turned_into_branch(self):
+        new_tree = 1 * self.tree
+        new_tree[0][1] *= OptionsArray('colour', ['red'])
+        self.assertEqual(diff(self.tree, new_tree),
+                         (['root_A_1_red'], ['root_A_1'], {}))
+
+    def test_diff_with_hooks(self):
+        new_tree = 1 * self.tree
+        new_tree.dict_hooks = [lambda od: od.update({'foo': 1})]
+        self.assertEqual(len(diff(self.tree, new_tree)[2]), 4)
+
+
+
+class TestSpec(unittest.TestCase):
+
+    def setUp(self):
+        letters = OptionsArray('letter', ['A', 'B'])
+        numbers = OptionsArray('number', range(2))
+        self.tree = OptionsNode('root') * letters * numbers
+        self.tree.update({'limits': (0, 1), 'product': letter_product})
+
+    def test_round_trip(self):
+        tree = from_spec(self.tree.to_spec())
+        self.assertEqual(tree, self.tree)
+        self.assertEqual([str(od) for od in tree.collapse()],
+                         [str(od) for od in self.tree.collapse()])
+        self.assertEqual([od['product'] for od in tree.collapse()],
+                         [0, 1, 0, 2])
+        self.assertEqual(tree.collapse()[0]['limits'], (0, 1))
+
+    def test_round_trip_through_json(self):
+        spec_str = json.dumps(self.tree.to_spec())
+        self.assertEqual(from_spec(spec_str), self.tree)
+        self.assertEqual(from_spec(json.loads(spec_str)), self.tree)
+
+    def test_round_trip_with_unicode(self):
+        self.tree.update({'title': u'caf\xe9', 'label': u'A',
+                          'units': ['m', u'\xb5m']})
+        tree = from_spec(json.dumps(self.tree.to_spec()))
+        self.assertEqual(tree, self.tree)
+        od = tree.collapse()[0]
+        self.assertEqual(od['title'], u'caf\xe9')
+        self.assertIs(type(od['label']), unicode)
+        self.assertEqual([type(u) for u in od['units']], [str, unicode])
+        self.assertIs(type(od['letter']), str)
+
+    def test_shared_subtrees(self):
+        spec = self.tree.to_spec()
+        # the root node, the letters and the numbers, each described
+        # by their values
+        self.assertEqual(len(spec['elements']), 3)
+        tree = from_spec(spec)
+        self.assertIs(tree._child._nodes[0]._child, tree._child._nodes[1]._child)
+        tree[0][0].update({'foo': 1})
+        self.assertEqual([('foo' in od) for od in tree.collapse()],
+                         [True, False, False, False])
+        self.assertNotIn('foo', self.tree.collapse()[0])
+
+    def test_nodes_shared_between_arrays(self):
+        original = self.tree.child
+        original[0][0].update({'colour': 'blue'})
+        original[1][0].update({'colour': 'red'})
+        tree = from_spec(original.to_spec())
+        self.assertEqual(tree, original)
+        # the numbers differ in their first node but share the second
+        self.assertIs(tree._nodes[0]._child._nodes[1],
+                      tree._nodes[1]._child._nodes[1])
+        tree[0][1].update({'foo': 1})
+        self.assertEqual([('foo' in od) for od in tree.collapse()],
+                         [False, True, False, False])
+
+    def test_nodes_with_differing_items(self):
+        original = self.tree.child
+        original[1].update({'colour': 'red'})
+        original[0][1] = 'one'
+        original.append(OptionsNode('C', {'letter': 'C'}, tags=['extra']))
+        tree = from_spec(original.to_spec())
+        self.assertEqual(tree, original)
+        self.assertEqual(tree[2].tags, ['extra'])
+        self.assertEqual([str(od) for od in tree.collapse()],
+                         [str(od) for od in original.collapse()])
+
+    def test_virtual_array(self):
+        tree = OptionsArray.from_range('number', 3, tags=['num']) * \
+               OptionsArray('letter', ['A', 'B'])
+        copied = from_spec(json.dumps(tree.to_spec()))
+        self.assertEqual(copied, tree)
+        self.assertEqual(copied.tags, ['num'])
+        self.assertEqual(copied.collapse(), tree.collapse())
+
+    def test_hooks(self):
+        self.tree.dict_hooks = [add_dependent_item]
+        tree = from_spec(self.tree.to_spec())
+        self.assertEqual(tree.dict_hooks, [add_dependent_item])
+
+    def test_lambda(self):
+        self.tree.update({'twice': lambda opt: 2 * opt['number']})
+        self.assertRaises(OptionsTreeElementException, self.tree.to_spec)
+
+    def test_bad_version(self):
+        spec = self.tree.to_spec()
+        spec['opiter_spec'] = 0
+        self.assertRaises(OptionsArrayException, from_spec, spec)
+
             
 if __name__ == '__main__':
     unittest.main()
@@ -88,6 +88,12 @@ class TestArrayNodeInfoBasics(unittest.TestCase):
         self.assertEqual(self.node_info.get_string(collection_separator=''),
                          'seqB')
 
+    def test_equality_with_names_in_other_sequences(self):
+        self.assertEqual(self.node_info,
+                         UnitArrayNodeInfo('seq', ('A', 'B', 'C'), 1))
+        self.assertFalse(self.node_info ==
+                         UnitArrayNodeInfo('seq', ('A', 'B', 'D'), 1))
+
         
 if __name__ == '__main__':
     unittest.main()
@@ -24,4 +24,4 @@ class UnitOptionsArray(OptionsArray):
 
     def create_node_info(self, index):
         "Throwaway implementation."
-        return ':'.join((self.name, str(self.nodes[index])))
+        return ':'.join((self.name, str(self.get_nodes()[index])))